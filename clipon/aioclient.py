@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import asyncio
+import json
+from dbus_next import Message, MessageType
+from dbus_next.aio import MessageBus
+from defines import *
+
+"""
+Asynchronous client library for integrations
+
+Unlike the client module which prints results for the command line,
+the methods here return data and can be awaited concurrently. All the
+requests share one bus connection, so a batch of them is pipelined to
+the daemon instead of waiting for each reply in turn.
+
+    async with AsyncClient() as client:
+        entries = await client.list(number=20)
+        async for event in client.subscribe():
+            print(event)
+"""
+
+DBUS_NAME = 'org.freedesktop.DBus'
+DBUS_PATH = '/org/freedesktop/DBus'
+
+# requests of list() in flight at once, below the replies the bus daemon
+# allows to be pending on a connection
+MAX_PENDING = 256
+
+class CliponError(Exception):
+    """
+    Error replied by the daemon or the bus
+    """
+    pass
+
+class AsyncClient:
+    """
+    Asyncio based client of the clipon daemon
+    """
+    bus = None
+
+    def __init__(self, bus = None):
+        self.bus = bus
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        self.disconnect()
+
+    async def connect(self):
+        if self.bus is None:
+            self.bus = await MessageBus().connect()
+        return self
+
+    def disconnect(self):
+        if self.bus is not None:
+            self.bus.disconnect()
+            self.bus = None
+
+    async def call(self, name, signature = '', body = ()):
+        """
+        Call a daemon method and return the list of values replied
+        """
+        msg = Message(destination=CLIPON_BUS_NAME,
+                      path=CLIPON_OBJ_PATH,
+                      interface=CLIPON_BUS_NAME + '.' + name,
+                      member=name,
+                      signature=signature,
+                      body=list(body))
+        reply = await self.bus.call(msg)
+        if reply.message_type == MessageType.ERROR:
+            raise CliponError("%s: %s" % (reply.error_name, reply.body))
+        return reply.body
+
+    async def size(self):
+        body = await self.call('history_size')
+        return int(body[0])
+
+    async def status(self):
+        body = await self.call('get_status')
+        return body[0]
+
+    async def info(self):
+        body = await self.call('get_info')
+        return json.loads(body[0])
+
+    async def get(self, index, start = 0, end = -1):
+        """
+        Return the entry at index as a dict with keys 'index', 'time',
+        'length' and 'text', or None if there is no such entry. Only
+        the slice [start, end) of the text is returned, negative end
+        means to the end.
+        """
+        body = await self.call('get_clip_range', 'iii', (index, start, end))
+        if len(body) == 0:
+            return None
+        entry = json.loads(body[0])
+        entry['index'] = index
+        return entry
+
+    async def list(self, start = None, number = None, reverse = False,
+                   short = -1):
+        """
+        Return a list of entries in range [start, start + number).
+        Negative start counts from the tail as the list command does,
+        by default the whole history is returned. If short is given,
+        texts are truncated to that many characters by the daemon. Up
+        to MAX_PENDING requests for the entries are in flight at the
+        same time.
+        """
+        size = await self.size()
+        if number is None or number > size:
+            number = size
+        if start is None:
+            start = -number
+        if start < 0:
+            start = max(size + start, 0)
+        end = min(start + number, size)
+
+        indexes = range(start, end)
+        if reverse:
+            indexes = reversed(indexes)
+
+        window = asyncio.Semaphore(MAX_PENDING)
+
+        async def get(index):
+            async with window:
+                return await self.get(index, 0, short)
+
+        entries = await asyncio.gather(*[get(i) for i in indexes])
+        return [e for e in entries if e is not None]
+
+    async def search(self, query, limit = 100):
+        """
+        Return at most limit entries containing query, newest first
+        """
+        body = await self.call('search_history', 'si', (query, limit))
+        return json.loads(body[0])
+
+    async def pick(self, query, top = 10, preview = -1):
+        """
+        Return at most top entries best matching query, best first,
+        each a dict with keys 'index', 'score' and 'text'
+        """
+        body = await self.call('pick', 'sii', (query, top, preview))
+        return json.loads(body[0])
+
+    async def use(self, index):
+        """
+        Record the entry at index as used, so it ranks higher in pick()
+        """
+        body = await self.call('use_clip', 'i', (index,))
+        return bool(body[0])
+
+    async def pinned(self):
+        """
+        Return the indexes of pinned entries, oldest first
+        """
+        body = await self.call('get_pinned')
+        return json.loads(body[0])
+
+    async def subscribe(self):
+        """
+        Asynchronous iterator over history events. Each event is a dict
+        with key 'event' being either 'added', along with the new
+        'entry', or 'changed', along with the new 'size' when entries
+        were deleted or cleared. The entry has its 'index', 'time',
+        'length' in bytes and the 'preview' of its first characters,
+        the whole text is got with get().
+        """
+        queue = asyncio.Queue()
+
+        def handler(msg):
+            if msg.message_type != MessageType.SIGNAL:
+                return
+            if msg.path != CLIPON_OBJ_PATH:
+                return
+            if msg.member == 'clip_added':
+                index, time, length, preview = msg.body
+                entry = {'index': index, 'time': time, 'length': length,
+                         'preview': preview}
+                queue.put_nowait({'event': 'added', 'entry': entry})
+            elif msg.member == 'history_changed':
+                queue.put_nowait({'event': 'changed', 'size': msg.body[0]})
+
+        rule = "type='signal',path='%s'" % CLIPON_OBJ_PATH
+        await self.call_bus('AddMatch', 's', (rule,))
+        self.bus.add_message_handler(handler)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.bus.remove_message_handler(handler)
+            if self.bus.connected:
+                await self.call_bus('RemoveMatch', 's', (rule,))
+
+    async def call_bus(self, name, signature, body):
+        msg = Message(destination=DBUS_NAME,
+                      path=DBUS_PATH,
+                      interface=DBUS_NAME,
+                      member=name,
+                      signature=signature,
+                      body=list(body))
+        reply = await self.bus.call(msg)
+        if reply.message_type == MessageType.ERROR:
+            raise CliponError("%s: %s" % (reply.error_name, reply.body))
+        return reply.body
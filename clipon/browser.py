@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import curses
+import threading
+from collections import OrderedDict
+from transport import TransportError
+from defines import CLIPON_OBJ_PATH
+
+"""
+Interactive browser of the clip history
+
+Entries are fetched by pages of PAGE_SIZE and kept in an LRU cache of
+pages keyed by the history version and the page number. Only a preview
+of each entry is fetched, about as many characters as fit on a line.
+While scrolling, the next pages in the scrolling direction are fetched
+by a background thread, so they are cached by the time they're shown.
+
+The daemon signals each clip added and each other change of history.
+Clips appended at the tail don't change the index of the others, the
+cached pages stay valid. Any other change bumps the version, which
+invalidates the whole cache. Without GLib to receive signals, the size
+of history is polled instead.
+"""
+
+PAGE_SIZE = 64
+PREVIEW_CHARS = 256 #characters fetched per entry, wide enough for a line
+CACHE_PAGES = 256 #pages kept in cache, a few MB at most
+PREFETCH_PAGES = 4 #pages fetched ahead in the scrolling direction
+TICK = 100 #milliseconds between checks for daemon events
+POLL_TICKS = 10 #ticks between polls of the size without signals
+
+def addline(stdscr, row, line, width, attr = 0):
+    try:
+        stdscr.addnstr(row, 0, line, width, attr)
+    except curses.error:
+        pass # wide characters overflowing the last column
+
+class PageCache:
+    """
+    LRU cache of pages, each a list of preview texts
+    """
+    pages = None
+    capacity = 0
+
+    def __init__(self, capacity = CACHE_PAGES):
+        self.pages = OrderedDict()
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+    def get(self, version, page):
+        with self.lock:
+            texts = self.pages.get((version, page), None)
+            if texts is not None:
+                self.pages.move_to_end((version, page))
+            return texts
+
+    def put(self, version, page, texts):
+        with self.lock:
+            self.pages[(version, page)] = texts
+            self.pages.move_to_end((version, page))
+            while len(self.pages) > self.capacity:
+                self.pages.popitem(last=False)
+
+    def drop(self, page):
+        # the last page is partial, it grows as clips are appended
+        with self.lock:
+            for key in [k for k in self.pages if k[1] == page]:
+                del self.pages[key]
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.pages
+
+class Prefetcher(threading.Thread):
+    """
+    Fetch pages in background through a connection of its own
+    """
+    def __init__(self, browser, transport):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.browser = browser
+        self.transport = transport
+        self.wanted = []
+        self.cond = threading.Condition()
+        self.stopped = False
+
+    def want(self, version, pages):
+        with self.cond:
+            self.wanted = [(version, p) for p in pages]
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.wanted) == 0 and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                version, page = self.wanted.pop(0)
+            try:
+                self.browser.load_page(self.transport, version, page)
+            except (TransportError, OSError):
+                return
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.transport.close()
+
+class Browser:
+    """
+    Curses view of the history, newest entries first
+    """
+    size = 0
+    version = 0
+    top = 0 #position of the first line shown, 0 being the newest entry
+    cursor = 0
+
+    def __init__(self, req, open_transport):
+        self.req = req # DBus requests by method name
+        self.cache = PageCache()
+        self.transport = open_transport()
+        self.prefetcher = None
+        if self.transport is not None:
+            self.prefetcher = Prefetcher(self, open_transport())
+        self.direction = 1
+        self.events = [] # signals received, applied between key strokes
+        self.signals = False
+
+    def subscribe(self):
+        """
+        Receive the signals of the daemon, return False if it's not
+        supported
+        """
+        try:
+            from gi.repository import GLib
+            from dbus.mainloop.glib import DBusGMainLoop
+        except ImportError:
+            return False
+
+        import dbus
+        # a connection of its own, the shared one has no main loop
+        bus = dbus.SessionBus(mainloop=DBusGMainLoop(), private=True)
+        bus.add_signal_receiver(self.on_clip_added, signal_name='clip_added',
+                                path=CLIPON_OBJ_PATH)
+        bus.add_signal_receiver(self.on_history_changed,
+                                signal_name='history_changed',
+                                path=CLIPON_OBJ_PATH)
+        self.bus = bus
+        self.context = GLib.MainContext.default()
+        return True
+
+    def on_clip_added(self, index, time, length, preview):
+        self.events.append(('added', int(index)))
+
+    def on_history_changed(self, size):
+        self.events.append(('changed', int(size)))
+
+    def dispatch_events(self):
+        """
+        Apply the events received since last check, return whether
+        anything changed
+        """
+        while self.context.pending():
+            self.context.iteration(False)
+        events, self.events = self.events, []
+        for event, value in events:
+            if event == 'added' and value == self.size:
+                self.cache.drop(value // PAGE_SIZE)
+                self.size += 1
+                if self.top > 0:
+                    # keep showing the same entries
+                    self.top += 1
+                    self.cursor += 1
+            else:
+                # older entries were deleted, indexes have changed
+                size = value + 1 if event == 'added' else value
+                self.invalidate(size)
+        return len(events) > 0
+
+    def poll_size(self):
+        size = int(self.req('history_size').history_size())
+        if size == self.size:
+            return False
+        self.invalidate(size)
+        return True
+
+    def invalidate(self, size):
+        self.version += 1
+        self.cache.clear()
+        self.size = size
+        self.top = min(self.top, max(size - 1, 0))
+        self.cursor = min(self.cursor, max(size - 1, 0))
+
+    def load_page(self, transport, version, page):
+        """
+        Fetch a page into the cache, unless it's cached already or the
+        history changed meanwhile
+        """
+        if (version, page) in self.cache:
+            return
+        start = page * PAGE_SIZE
+        end = min(start + PAGE_SIZE, self.size)
+        if start >= end:
+            return
+        if transport is not None:
+            found = transport.get_many(range(start, end), 0, PREVIEW_CHARS)
+            texts = [t.decode('utf-8', 'replace') if t is not None else None
+                     for t in found]
+        else:
+            import json
+            req = self.req('get_clip_range')
+            texts = []
+            for index in range(start, end):
+                entry = req.get_clip_range(index, 0, PREVIEW_CHARS)
+                texts.append(json.loads(entry)['text'] if entry else None)
+        if version == self.version:
+            self.cache.put(version, page, texts)
+
+    def get_text(self, index):
+        page = index // PAGE_SIZE
+        texts = self.cache.get(self.version, page)
+        if texts is None:
+            self.load_page(self.transport, self.version, page)
+            texts = self.cache.get(self.version, page)
+            if texts is None:
+                return None
+        offset = index - page * PAGE_SIZE
+        return texts[offset] if offset < len(texts) else None
+
+    def prefetch(self, height):
+        if self.prefetcher is None:
+            return
+        # pages beyond the screen in the scrolling direction, newest
+        # entries being shown first
+        if self.direction > 0:
+            edge = self.size - 1 - min(self.top + height, self.size - 1)
+        else:
+            edge = self.size - 1 - self.top
+        first = edge // PAGE_SIZE
+        step = -self.direction
+        pages = [first + step * i for i in range(1, PREFETCH_PAGES + 1)]
+        pages = [p for p in pages if 0 <= p * PAGE_SIZE < self.size and
+                 (self.version, p) not in self.cache]
+        if len(pages) > 0:
+            self.prefetcher.want(self.version, pages)
+
+    def draw(self, stdscr):
+        height, width = stdscr.getmaxyx()
+        width = max(width - 1, 1)
+        stdscr.erase()
+        lines = height - 1
+        digits = len(str(max(self.size - 1, 0)))
+        for row in range(min(lines, self.size - self.top)):
+            index = self.size - 1 - self.top - row
+            text = self.get_text(index)
+            if text is None:
+                text = ''
+            line = "%*d: %s" % (digits, index, text.replace('\n', ' '))
+            attr = curses.A_REVERSE if self.top + row == self.cursor else 0
+            addline(stdscr, row, line, width, attr)
+        status = " %d/%d  j/k: move  space/b: page  g/G: ends  enter: view  q: quit" % (
+            self.size - self.cursor if self.size > 0 else 0, self.size)
+        addline(stdscr, lines, status, width, curses.A_BOLD)
+        stdscr.refresh()
+        self.prefetch(lines)
+
+    def move(self, delta, height):
+        if self.size == 0:
+            return
+        self.direction = 1 if delta > 0 else -1
+        self.cursor = min(max(self.cursor + delta, 0), self.size - 1)
+        if self.cursor < self.top:
+            self.top = self.cursor
+        elif self.cursor >= self.top + height:
+            self.top = self.cursor - height + 1
+
+    def view(self, stdscr, index):
+        """
+        Show the whole text of an entry
+        """
+        if self.transport is not None:
+            try:
+                text = self.transport.blob(index).decode('utf-8', 'replace')
+            except TransportError:
+                return
+        else:
+            import json
+            entry = self.req('get_clip_entry').get_clip_entry(index)
+            if not entry:
+                return
+            text = json.loads(entry)['text']
+
+        lines = text.splitlines()
+        top = 0
+        while True:
+            height, width = stdscr.getmaxyx()
+            stdscr.erase()
+            for row, line in enumerate(lines[top:top + height - 1]):
+                addline(stdscr, row, line, width - 1)
+            addline(stdscr, height - 1, " entry %d  j/k: scroll  q: back" % index,
+                    width - 1, curses.A_BOLD)
+            stdscr.refresh()
+            key = stdscr.getch()
+            if key in (ord('q'), 27, curses.KEY_LEFT):
+                return
+            elif key in (ord('j'), curses.KEY_DOWN):
+                top = min(top + 1, max(len(lines) - 1, 0))
+            elif key in (ord('k'), curses.KEY_UP):
+                top = max(top - 1, 0)
+            elif key in (ord(' '), curses.KEY_NPAGE):
+                top = min(top + height - 1, max(len(lines) - 1, 0))
+            elif key in (ord('b'), curses.KEY_PPAGE):
+                top = max(top - height + 1, 0)
+
+    def run(self, stdscr):
+        curses.curs_set(0)
+        stdscr.timeout(TICK)
+        self.signals = self.subscribe()
+        self.size = int(self.req('history_size').history_size())
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+
+        ticks = 0
+        dirty = True
+        while True:
+            if dirty:
+                self.draw(stdscr)
+                dirty = False
+
+            key = stdscr.getch()
+            height = stdscr.getmaxyx()[0] - 1
+            if self.signals:
+                dirty = self.dispatch_events()
+            elif key == -1:
+                ticks += 1
+                if ticks % POLL_TICKS == 0:
+                    dirty = self.poll_size()
+            if key == -1:
+                continue
+
+            dirty = True
+            if key in (ord('q'), 27):
+                break
+            elif key in (ord('j'), curses.KEY_DOWN):
+                self.move(1, height)
+            elif key in (ord('k'), curses.KEY_UP):
+                self.move(-1, height)
+            elif key in (ord(' '), curses.KEY_NPAGE):
+                self.move(height, height)
+            elif key in (ord('b'), curses.KEY_PPAGE):
+                self.move(-height, height)
+            elif key in (ord('G'), curses.KEY_END):
+                self.move(self.size, height)
+            elif key in (ord('g'), curses.KEY_HOME):
+                self.move(-self.size, height)
+            elif key in (ord('\n'), curses.KEY_ENTER, curses.KEY_RIGHT):
+                if self.size > 0:
+                    self.view(stdscr, self.size - 1 - self.cursor)
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.transport is not None:
+            self.transport.close()
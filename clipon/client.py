@@ -1,28 +1,34 @@
 #!/usr/bin/env python3
 from __future__ import absolute_import
 import dbus
-import json
-import subprocess
-from time import sleep
 from defines import *
 import sys
 import os
 
 """
 Client module for communicating with daemon via DBus
+
+Modules not needed by every command are imported by the functions
+using them, to keep short commands like 'clipon size' fast.
 """
 
 def clipon_dbus_req(name):
     req = None
 
     bus = dbus.SessionBus()
-    try:
-        bus.get_name_owner(CLIPON_BUS_NAME)
-    except dbus.DBusException as e:
-        start_daemon()
+    if not bus.name_has_owner(CLIPON_BUS_NAME):
+        if CLIPON_BUS_NAME in bus.list_activatable_names():
+            # the bus daemon returns once the daemon owns the name
+            bus.start_service_by_name(CLIPON_BUS_NAME)
+        else:
+            # quietly, the output of the command may be parsed
+            start_daemon(quiet=True)
 
     try:
-        session = bus.get_object(CLIPON_BUS_NAME, CLIPON_OBJ_PATH)
+        # methods are called through their interface, no need to
+        # introspect the object with an extra round trip
+        session = bus.get_object(CLIPON_BUS_NAME, CLIPON_OBJ_PATH,
+                                 introspect=False)
         method = CLIPON_BUS_NAME + '.' + name
         req = dbus.Interface(session, method)
     except dbus.DBusException as e:
@@ -30,6 +36,17 @@ def clipon_dbus_req(name):
 
     return req
 
+def open_transport():
+    """
+    Connect to the bulk data socket of the daemon, return None if the
+    daemon doesn't listen on it
+    """
+    from transport import TransportClient
+    try:
+        return TransportClient()
+    except OSError:
+        return None
+
 def print_status():
     req = clipon_dbus_req('get_status')
     if req is None:
@@ -38,16 +55,18 @@ def print_status():
     print(req.get_status())
 
 def config_clipon(cfg):
-    req = clipon_dbus_req('config')
+    import json
+    req = clipon_dbus_req('set_config')
     if req is None:
         return
 
-    for key, value in cfg.items():
-        ret = req.config(key, value)
-        if not ret:
-            print("Failed to set option %s to value %s" % (key, value))
+    # all options in one transaction
+    if not req.set_config(json.dumps(cfg)):
+        print("Failed to set options %s" % ', '.join(
+            "%s to %s" % (key, value) for key, value in cfg.items()))
 
 def print_info():
+    import json
     req = clipon_dbus_req('get_info')
     if req is None:
         return
@@ -57,6 +76,151 @@ def print_info():
         info = json.loads(info) #convert to dict
         print(json.dumps(info, sort_keys=True, indent=5, separators=(',', ': ')))
 
+def print_bars(labels, counts, width = 50):
+    peak = max(counts) if len(counts) > 0 else 0
+    for label, count in zip(labels, counts):
+        bar = '#' * (count * width // peak) if peak > 0 else ''
+        print("%12s %8d %s" % (label, count, bar))
+
+def print_stats(top, histogram):
+    import json
+    from time import strftime, gmtime
+
+    req = clipon_dbus_req('get_stats')
+    if req is None:
+        return
+
+    stats = json.loads(req.get_stats(top, 60))
+    print("Total clips: %d" % stats['size'])
+    print("Total size: %d bytes" % stats['total_length'])
+    if stats['size'] == 0:
+        return
+
+    growth = stats['growth']
+    print("Days with clips: %d, %.1f clips per day" %
+          (len(growth), stats['size'] / len(growth)))
+
+    if histogram:
+        print("\nClips per hour of day:")
+        print_bars(['%02d:00' % h for h in range(24)], stats['per_hour'])
+
+        print("\nClip length:")
+        sizes = stats['sizes']
+        print_bars(['< %d' % (2 << i) for i in range(len(sizes))], sizes)
+
+        print("\nStorage growth:")
+        # days are counted in local time already, not to be shifted again
+        print_bars([strftime('%Y-%m-%d', gmtime(d)) for d, g in growth],
+                   [g for d, g in growth])
+
+    if len(stats['repeated']) > 0:
+        print("\nMost repeated clips:")
+        for index, count, text in stats['repeated']:
+            text = text.replace('\n', ' ')
+            print("%8d times, latest %d: %s" % (count, index, text))
+
+def pin_entry(index, pin):
+    method = 'pin' if pin else 'unpin'
+    req = clipon_dbus_req(method)
+    if req is None:
+        return
+
+    if not getattr(req, method)(index):
+        if pin:
+            print("Entry %d not exists" % index)
+        else:
+            print("Entry %d is not pinned" % index)
+
+def pick_clips(query, number, short, use):
+    import json
+
+    req = clipon_dbus_req('pick')
+    if req is None:
+        return
+
+    if use:
+        found = json.loads(req.pick(query, 1, -1))
+        if len(found) == 0:
+            return
+        req = clipon_dbus_req('use_clip')
+        if req is None:
+            return
+        req.use_clip(found[0]['index'])
+        sys.stdout.write(found[0]['text'])
+        return
+
+    for entry in json.loads(req.pick(query, number, short)):
+        text = entry['text'].replace('\n', ' ')
+        print("%d: %s" % (entry['index'], text))
+
+READ_CHUNK = 65536
+BATCH_BYTES = 4 * 1024 * 1024 #max size of clips sent in one call
+
+def read_clips(files, sep):
+    """
+    Iterate over the clips of files, '-' being stdin, separated by sep.
+    Files are read in chunks, so they don't have to fit in memory.
+    """
+    for path in files:
+        f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        rest = b''
+        try:
+            while True:
+                chunk = f.read(READ_CHUNK)
+                if len(chunk) == 0:
+                    break
+                clips = (rest + chunk).split(sep)
+                rest = clips.pop()
+                for clip in clips:
+                    yield clip
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+        if len(rest) > 0:
+            yield rest
+
+def add_clips(files, null, timestamps, batch):
+    """
+    Add the clips read from files, one per line or NUL separated, in
+    batches. With timestamps, each clip starts with its time in seconds
+    since epoch followed by a tab.
+    """
+    req = clipon_dbus_req('add_clips')
+    if req is None:
+        return
+
+    sep = b'\0' if null else b'\n'
+    total = 0
+    pending = []
+    size = 0
+    for clip in read_clips(files or ['-'], sep):
+        text = clip.decode('utf-8', 'replace')
+        t = 0.0
+        if timestamps:
+            stamp, tab, rest = text.partition('\t')
+            try:
+                t = float(stamp) if tab else -1.0
+            except ValueError:
+                t = -1.0
+            if t > 0:
+                text = rest
+            else:
+                print("Invalid timestamp %r, clip added as of now" % stamp[:32])
+                t = 0.0
+        if len(text) == 0:
+            continue
+
+        pending.append((text, t))
+        size += len(clip)
+        if len(pending) >= batch or size >= BATCH_BYTES:
+            total += req.add_clips(dbus.Array(pending, signature='(sd)'))
+            pending = []
+            size = 0
+
+    if len(pending) > 0:
+        total += req.add_clips(dbus.Array(pending, signature='(sd)'))
+    print("Added %d clips" % total)
+
 def clear_history():
     req = clipon_dbus_req('clear_history')
     if req is None:
@@ -99,18 +263,71 @@ def ping_daemon():
         return False
     return True
 
-def start_daemon():
+def get_daemon_cmd(headless = False):
     cwd = os.path.dirname(os.path.abspath(__file__))
     daemon_path = os.path.join(cwd, 'daemon.py')
+    cmd = [sys.executable, daemon_path]
+    if headless:
+        cmd.append('--headless')
+    return cmd
+
+def start_daemon(timeout = 30, headless = False, quiet = False):
+    """
+    Start the daemon and wait until it tells it's ready through a pipe.
+    Errors are printed to stderr, and so is the time it took unless
+    quiet.
+    """
+    import subprocess
+    import select
+    from time import time
+
+    rfd, wfd = os.pipe()
+    cmd = get_daemon_cmd(headless) + ['--notify-fd=%d' % wfd]
     fd = open('/dev/null', 'a+')
-    subprocess.Popen(['python', daemon_path], stdin=fd, stdout=fd, stderr=fd)
-    ready = ping_daemon()
-    while not ready:
-        sleep(0.1) #sleep 1 millisecond
-        ready = ping_daemon()
-
-    if ready:
-        print("Daemon started")
+    begin = time()
+    subprocess.Popen(cmd, stdin=fd, stdout=fd, stderr=fd, pass_fds=(wfd,))
+    os.close(wfd)
+
+    msg = b''
+    while not msg.endswith(b'\n'):
+        ready, _, _ = select.select([rfd], [], [], timeout)
+        if not ready:
+            break
+        data = os.read(rfd, 256)
+        if len(data) == 0:
+            break #daemon exited
+        msg += data
+    os.close(rfd)
+
+    msg = msg.decode('utf-8').strip()
+    if msg == 'READY':
+        if not quiet:
+            print("Daemon started in %.3f seconds" % (time() - begin),
+                  file=sys.stderr)
+    elif msg.startswith('ERROR '):
+        print(msg[len('ERROR '):], file=sys.stderr)
+    else:
+        print("Failed to start daemon", file=sys.stderr)
+
+def install_service(headless = False):
+    """
+    Install a DBus service file, so that the daemon is started by the
+    bus daemon on demand
+    """
+    data_dir = os.environ.get('XDG_DATA_HOME')
+    if not data_dir:
+        data_dir = os.path.join(os.path.expanduser('~'), '.local', 'share')
+    service_dir = os.path.join(data_dir, 'dbus-1', 'services')
+    if not os.path.exists(service_dir):
+        os.makedirs(service_dir)
+
+    service_file = os.path.join(service_dir, CLIPON_BUS_NAME + '.service')
+    f = open(service_file, 'w')
+    f.write("[D-BUS Service]\n")
+    f.write("Name=%s\n" % CLIPON_BUS_NAME)
+    f.write("Exec=%s\n" % ' '.join(get_daemon_cmd(headless)))
+    f.close()
+    print("Installed %s" % service_file)
 
 def stop_daemon():
     req = clipon_dbus_req('stop')
@@ -119,13 +336,20 @@ def stop_daemon():
     req.stop()
     print("Daemon stopped")
 
-def print_history(start, number, raw, short, reverse):
+def print_history(start, number, raw, short, reverse, group = False,
+                  pinned = False, fmt = None):
+    import json
+    from transport import TransportError
+
     req = clipon_dbus_req('history_size')
     if req is None:
         return
     size = req.history_size()
     if size == 0:
-        print("History is empty")
+        if fmt is not None:
+            stream_history([], reverse, fmt, short)
+        else:
+            print("History is empty")
         return
 
     if number > size:
@@ -145,37 +369,174 @@ def print_history(start, number, raw, short, reverse):
         print("Invalid range [%d, %d). Total is %d\n" % (start, end, size))
         return
 
-    if reverse:
-        num_range = reversed(range(start, end))
+    # near-duplicates are printed once, as their latest entry
+    similar = {}
+    if group:
+        req = clipon_dbus_req('group_similar')
+        if req is None:
+            return
+        for indexes in json.loads(req.group_similar(start, end)):
+            similar[indexes[-1]] = len(indexes) - 1
+        num_range = sorted(similar)
     else:
         num_range = range(start, end)
 
-    req = clipon_dbus_req('get_clip_entry')
-    if req is None:
+    if pinned:
+        req = clipon_dbus_req('get_pinned')
+        if req is None:
+            return
+        num_range = [i for i in json.loads(req.get_pinned()) if i in num_range]
+
+    if fmt is not None:
+        stream_history(num_range, reverse, fmt, short)
         return
 
-    for index in num_range:
-        # Call the methods using the interface
-        entry = req.get_clip_entry(index)
-        if entry is None:
-            print("Entry %s not exists" % index)
-            continue
+    if reverse:
+        num_range = reversed(num_range)
 
-        entry = json.loads(entry)
-        text = entry.get('text', None)
+    transport = open_transport()
+    if transport is None:
+        req = clipon_dbus_req('get_clip_range')
+        if req is None:
+            return
 
-        if entry is None:
-            print("Invalid entry %s" % index)
-            continue
+    # only the short part of each entry is read and transferred
+    for index in num_range:
+        if transport is not None:
+            try:
+                text = transport.get(index, 0, short).decode('utf-8')
+            except TransportError:
+                print("Entry %s not exists" % index)
+                continue
+        else:
+            # Call the methods using the interface
+            entry = req.get_clip_range(index, 0, short if short < INT_MAX else -1)
+            if entry is None:
+                print("Entry %s not exists" % index)
+                continue
+
+            entry = json.loads(entry)
+            text = entry.get('text', None)
 
-        if short < len(text):
-            text = text[0:short]
+            if text is None:
+                print("Invalid entry %s" % index)
+                continue
 
         if raw:
             print("%s" % text)
+        elif similar.get(index, 0) > 0:
+            print("%d (+%d similar): %s" % (index, similar[index], text))
         else:
             print("%d: %s" % (index, text))
 
+    if transport is not None:
+        transport.close()
+
+def browse_history():
+    import curses
+    from browser import Browser
+
+    if clipon_dbus_req('history_size') is None:
+        return
+    browser = Browser(clipon_dbus_req, open_transport)
+    curses.wrapper(browser.run)
+
+EXPORT_CHUNK = 256 #entries exported at once when not in one range
+WRITE_BUFFER = 65536
+
+def export_entries(transport, indexes, reverse, short = INT_MAX):
+    """
+    Iterate over (index, time, length, data) of the entries, through
+    the transport socket if connected or DBus otherwise. Data has at
+    least the first short characters of the text, length is the size
+    of the whole text without the ending newline.
+    """
+    import json
+    indexes = sorted(indexes)
+    if len(indexes) == 0:
+        return
+
+    if transport is None:
+        req = clipon_dbus_req('get_clip_range')
+        if req is None:
+            return
+        for index in (reversed(indexes) if reverse else indexes):
+            entry = req.get_clip_range(index, 0, -1)
+            if entry is not None:
+                entry = json.loads(entry)
+                data = entry['text'].encode('utf-8')
+                yield index, entry['time'], len(data) - data.endswith(b'\n'), data
+        return
+
+    first, last = indexes[0], indexes[-1] + 1
+    if not reverse and len(indexes) == last - first:
+        # streamed by the daemon in one go
+        for entry in transport.export(first, last, short):
+            yield entry
+        return
+
+    wanted = set(indexes)
+    chunks = range(first, last, EXPORT_CHUNK)
+    for start in (reversed(chunks) if reverse else chunks):
+        found = [e for e in transport.export(start, min(start + EXPORT_CHUNK, last),
+                                             short)
+                 if e[0] in wanted]
+        for entry in (reversed(found) if reverse else found):
+            yield entry
+
+def stream_history(indexes, reverse, fmt, short):
+    """
+    Write entries to stdout as a JSON array, one JSON object per line,
+    or texts ended by NUL. Objects have the index, time, length in
+    bytes and text of the entries, without the newline clipon adds to
+    each clip.
+    """
+    import json
+
+    transport = open_transport()
+    out = sys.stdout.buffer
+    buf = bytearray()
+    num = 0
+    try:
+        if fmt == 'json':
+            buf += b'['
+        for index, t, length, data in export_entries(transport, indexes,
+                                                     reverse, short):
+            # only the short part of each entry is transferred
+            text = str(data[:length], 'utf-8', 'replace')
+            if short < len(text):
+                text = text[:short]
+
+            if fmt == 'nul':
+                buf += text.encode('utf-8') + b'\0'
+            else:
+                record = json.dumps({'index': index, 'time': t,
+                                     'length': length, 'text': text},
+                                    ensure_ascii=False).encode('utf-8')
+                if fmt == 'json':
+                    buf += b',\n' if num > 0 else b'\n'
+                    buf += record
+                else:
+                    buf += record + b'\n'
+            num += 1
+
+            if len(buf) >= WRITE_BUFFER:
+                out.write(buf)
+                buf.clear()
+
+        if fmt == 'json':
+            buf += b'\n]\n' if num > 0 else b']\n'
+        out.write(buf)
+        out.flush()
+    except BrokenPipeError:
+        # the reader is gone, like head, don't fetch the rest. Stdout
+        # is redirected not to fail again when flushed at exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    finally:
+        if transport is not None:
+            transport.close()
+
 def delete_history(start, number):
     req = clipon_dbus_req('del_history')
     if req is None:
@@ -6,11 +6,12 @@
 #
 
 from __future__ import absolute_import
-from docopt import docopt
+import os
 import sys
-import client
-from helper import INT_MAX
-from defines import CLIPON_VERSION
+from defines import CLIPON_VERSION, INT_MAX
+
+# Modules like docopt and client are imported when needed, so that each
+# subcommand only pays for what it uses.
 
 __version__ = CLIPON_VERSION
 __author__  = 'Jin Xu <jinuxstyle@hotmail.com>'
@@ -28,10 +29,16 @@ General Options:
 Commands:
  start          Start clipon daemon
  list           List clipboard history
+ browse         Browse clipboard history interactively
+ add            Add clips from files or stdin
+ pick           Find clips best matching a query
+ pin            Keep an entry when older ones are deleted
+ unpin          Unpin an entry
  clear          Clear history
  size           Total number of items
  config         Configure clipon
  info           Summary about clipon configuration and history
+ stats          Statistics about clipboard usage
  pause          Pause tracking clipboard
  resume         Resume tracking clipboard
  stop           Stop and quit clipon daemon
@@ -55,6 +62,15 @@ Options:
   --raw                 List history entries in raw format. Information
                         added by clipon are excluded.
   --before=<date time>  List history entries added before the given time
+  --pinned              List pinned entries only
+  --format=<format>     Print entries for other programs, as json for a
+                        JSON array, ndjson for a JSON object per line,
+                        or nul for texts ended by NUL. Objects have the
+                        index, time, length and text of entries.
+  --group-similar       List near-duplicate entries once, as the latest
+                        of them along with the number of others. Clips
+                        differing only in case, digits or whitespace,
+                        or in a few characters, are near-duplicates.
 
 Examples:
 
@@ -64,15 +80,23 @@ Examples:
     $ clipon list -n 10
   list the oldest 10 entries:
     $ clipon list -n 10 --start=0
+  list the latest 100 entries without near-duplicates:
+    $ clipon list -n 100 --group-similar
+  choose one of the latest 100 entries with fzf:
+    $ clipon list -n 100 --format nul | fzf --read0
 
 """
 
 def do_list(args):
+    import client
     num_entry   = args['--number']
     start_entry = args['--start']
     reverse     = args['--reverse']
     short       = args['--short']
     raw         = args['--raw']
+    group       = args['--group-similar']
+    pinned      = args['--pinned']
+    fmt         = args['--format']
 
     if num_entry is None:
         num_entry = INT_MAX
@@ -95,7 +119,12 @@ def do_list(args):
             print("Invalid value for option --short. Shall be greater than 0")
             return
 
-    client.print_history(start_entry, num_entry, raw, short, reverse)
+    if fmt is not None and fmt not in ('json', 'ndjson', 'nul'):
+        print("Invalid value for option --format. Shall be json, ndjson or nul")
+        return
+
+    client.print_history(start_entry, num_entry, raw, short, reverse, group,
+                         pinned, fmt)
 
 delete_doc = """
 usage: clipon delete [options]
@@ -109,6 +138,7 @@ Options:
 """
 
 def do_delete(args):
+    import client
     start_entry = args['--start']
     num_entry = int(args['--number'])
 
@@ -143,18 +173,71 @@ Options:
                             of a clip is longer than the given value, it
                             will be truncated to the given length. But it
                             doesn't apply to existing clips.
+  --max-age=<age>           Maximum age of history entries, no limit by
+                            default. Older ones are deleted periodically.
+                            The age is in seconds, or with a suffix of
+                            m, h or d for minutes, hours or days.
+  --socket=<string>         Serve bulk data through a unix socket besides
+                            DBus, true by default
+  --follow=<socket>         Replicate the history of another daemon on
+                            the same host, given the path of its socket
+                            as shown by 'clipon info'. Its entries are
+                            merged in time order, two daemons may follow
+                            each other. An empty path stops following.
+  --primary=<string>        Capture the primary selection, the text
+                            selected with the mouse, besides the
+                            clipboard, false by default. A selection
+                            being extended replaces the partial one,
+                            and text selected then copied is kept once.
+  --secrets=<action>        Redact or drop clips with secrets like tokens,
+                            passwords or private keys when copied, off by
+                            default. The action is redact, drop or off.
+                            Custom patterns are read from the filters
+                            file shown by 'clipon info', a list like
+                            [{"name": "ticket", "pattern": "T-[0-9]+",
+                            "action": "redact"}].
 
 Examples:
 
   Do not save history to file
     $ clipon config --autosave false
 
+  Delete entries older than 30 days
+    $ clipon config --max-age 30d
+
+  Follow the daemon of another session
+    $ clipon config --follow /run/user/1001/clipon/clipon.sock
+
+  Do not keep passwords and tokens copied
+    $ clipon config --secrets redact
+
 """
 
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_age(age):
+    """
+    Convert an age like 90, 30m or 7d to seconds, None if invalid
+    """
+    unit = 1
+    if len(age) > 0 and age[-1] in AGE_UNITS:
+        unit = AGE_UNITS[age[-1]]
+        age = age[:-1]
+    try:
+        return int(age) * unit
+    except ValueError:
+        return None
+
 def do_config(args):
+    import client
     autosave = args['--autosave']
     max_entry = args['--max-entry']
     max_length = args['--max-length']
+    max_age = args['--max-age']
+    socket = args['--socket']
+    follow = args['--follow']
+    secrets = args['--secrets']
+    primary = args['--primary']
     cfg = {}
 
     if autosave is not None:
@@ -182,16 +265,68 @@ def do_config(args):
 
         cfg['max_length'] = max_length
 
+    if max_age is not None:
+        max_age = parse_age(max_age)
+        if max_age is None or max_age <= 0:
+            print('Invalid value for --max-age, shall be a duration greater than zero')
+            return
+
+        cfg['max_age'] = max_age
+
+    if socket is not None:
+        if socket == 'False' or socket == 'false':
+            socket = False
+        elif socket == 'True' or socket == 'true':
+            socket = True
+        else:
+            print('Invalid value for option --socket, shall be true or false')
+            return
+        cfg['socket'] = socket
+
+    if follow is not None:
+        if follow:
+            follow = os.path.abspath(os.path.expanduser(follow))
+        cfg['follow'] = follow
+
+    if primary is not None:
+        if primary == 'False' or primary == 'false':
+            primary = False
+        elif primary == 'True' or primary == 'true':
+            primary = True
+        else:
+            print('Invalid value for option --primary, shall be true or false')
+            return
+        cfg['primary'] = primary
+
+    if secrets is not None:
+        if secrets not in ('redact', 'drop', 'off'):
+            print('Invalid value for option --secrets, shall be redact, drop or off')
+            return
+        cfg['secrets'] = secrets
+
     if len(cfg) > 0:
         client.config_clipon(cfg)
 
 start_doc = """
-usage: clipon start
+usage: clipon start [options]
 
 Start clipon daemon
+
+Options:
+  --install-service     Install a DBus service file so that the daemon
+                        is started by DBus on demand instead
+  --headless            Do not monitor the clipboard, which needs a
+                        display. Clips are added through DBus or
+                        written to the FIFO shown by 'clipon info'.
+                        It's the default if there is no display.
+
 """
 def do_start(args):
-    client.start_daemon()
+    import client
+    if args['--install-service']:
+        client.install_service(headless=args['--headless'])
+        return
+    client.start_daemon(headless=args['--headless'])
 
 stop_doc = """
 usage: clipon stop
@@ -199,6 +334,7 @@ usage: clipon stop
 Stop clipon daemon
 """
 def do_stop(args):
+    import client
     client.stop_daemon()
 
 pause_doc = """
@@ -207,6 +343,7 @@ usage: clipon pause
 Pause clipon daemon
 """
 def do_pause(args):
+    import client
     client.pause_daemon()
 
 resume_doc = """
@@ -215,6 +352,7 @@ usage: clipon resume
 Pause clipon daemon
 """
 def do_resume(args):
+    import client
     client.resume_daemon()
 
 size_doc = """
@@ -223,6 +361,7 @@ usage: clipon size
 Get the total number of clips
 """
 def do_size(args):
+    import client
     size = client.get_size()
     print(size)
 
@@ -232,6 +371,7 @@ usage: clipon clear
 Clear the clip history
 """
 def do_clear(args):
+    import client
     client.clear_history()
 
 save_doc = """
@@ -240,10 +380,12 @@ usage: clipon save
 Save clip history if autosave is not enabled
 """
 def do_save(args):
+    import client
     client.save_history()
 
 def do_help(argv):
     if len(argv) == 0:
+        from docopt import docopt
         docopt(main_doc, argv='-h')
     else:
         cmd = argv[0]
@@ -253,12 +395,142 @@ def do_help(argv):
         except KeyError:
             exit("%r is not a clipon command. See 'clipon -h|--help'." % cmd)
 
+stats_doc = """
+usage: clipon stats [options]
+
+Print statistics about clipboard usage
+
+Options:
+  --histogram           Print histograms of clips per hour of day, clip
+                        length and storage growth
+  --top=<number>        Number of most repeated clips to be printed
+                        [default: 5]
+
+"""
+def do_stats(args):
+    import client
+    top = int(args['--top'])
+    if top < 0:
+        print("Invalid value for option --top. Shall be greater or equal than 0")
+        return
+
+    client.print_stats(top, args['--histogram'])
+
+pin_doc = """
+usage: clipon pin <index>
+
+Pin an entry. Pinned entries are not deleted when the history exceeds
+the maximum number of entries or the maximum age, newer ones are deleted
+instead. See 'clipon list --pinned' for the pinned entries.
+"""
+def parse_index(index):
+    try:
+        return int(index)
+    except ValueError:
+        print("Invalid index %s. Shall be a number" % index)
+        return None
+
+def do_pin(args):
+    import client
+    index = parse_index(args['<index>'])
+    if index is not None:
+        client.pin_entry(index, True)
+
+unpin_doc = """
+usage: clipon unpin <index>
+
+Unpin an entry, so that it's deleted along with others of its age
+"""
+def do_unpin(args):
+    import client
+    index = parse_index(args['<index>'])
+    if index is not None:
+        client.pin_entry(index, False)
+
+pick_doc = """
+usage: clipon pick [options] <query>...
+
+Find clips fuzzy matching the query, that is containing its characters
+in order. The best matches are printed first, ranked by how well they
+match and how recently and often they were copied or used.
+
+Options:
+  --number=<number> -n  Number of clips to be printed [default: 10]
+  --short=<number>      Print at most given number of characters for each
+                        clip [default: 80]
+  --use                 Print only the text of the best match and record
+                        it as used, so it ranks higher next time
+
+Examples:
+
+  paste the best match of "ssh prod" with xdotool
+    $ xdotool type "$(clipon pick --use ssh prod)"
+
+"""
+def do_pick(args):
+    import client
+    number = int(args['--number'])
+    short = int(args['--short'])
+    if number <= 0 or short <= 0:
+        print("Invalid value for option --number or --short. Shall be greater than 0")
+        return
+
+    query = ' '.join(args['<query>'])
+    client.pick_clips(query, number, short, args['--use'])
+
+browse_doc = """
+usage: clipon browse
+
+Browse clipboard history interactively, newest entries first. Use j/k
+or arrows to move, space/b or page up/down to scroll by pages, g/G to
+go to the newest/oldest entry, enter to view the whole entry and q to
+quit. The view follows changes of history as they happen.
+"""
+def do_browse(args):
+    import client
+    client.browse_history()
+
+add_doc = """
+usage: clipon add [options] [<file>...]
+
+Add clips read from files, or from stdin if none is given or for '-'.
+Each line is a clip, or each NUL separated chunk with --null. Clips
+already in history, with the same text and time, are skipped.
+
+Options:
+  --null -0             Clips are separated by NUL characters instead
+                        of newlines, so they can span multiple lines
+  --timestamps          Each clip starts with its time, in seconds since
+                        epoch, followed by a tab. Clips are added at
+                        their place in history by time.
+  --batch=<number>      Number of clips sent to the daemon at once
+                        [default: 1000]
+
+Examples:
+
+  add the shell history as clips
+    $ clipon add ~/.bash_history
+  add multiline clips
+    $ printf 'first\\nclip\\0second\\nclip\\0' | clipon add -0
+
+"""
+def do_add(args):
+    import client
+    batch = int(args['--batch'])
+    if batch <= 0:
+        print("Invalid value for option --batch. Shall be greater than 0")
+        return
+
+    client.add_clips(args['<file>'], args['--null'], args['--timestamps'],
+                     batch)
+
 info_doc = """
 usage: clipon info
 
 Print summary info of clipon
 """
 def do_info(args):
+    import client
     client.print_info()
 
 status_doc = """
@@ -267,26 +539,44 @@ usage: clipon status
 Print status of clipon
 """
 def do_status(args):
+    import client
     client.print_status()
 
+def parse_args(cmd_doc, argv):
+    """
+    Parse the options of a subcommand with its own usage. Commands
+    without any option given are not parsed if they don't take options
+    nor arguments.
+    """
+    if len(argv) == 1 and 'Options:' not in cmd_doc and '<' not in cmd_doc:
+        return {}
+
+    from docopt import docopt
+    return docopt(cmd_doc, argv)
+
 def main(argv=None):
-    # parse the command line
-    args = docopt(main_doc,
-                  version='clipon version %s' % __version__,
-                  options_first=True,
-                  argv=argv or sys.argv[1:])
-    cmd = args['<command>']
-    argv = [args['<command>']] + args['<options>']
+    argv = argv or sys.argv[1:]
+
+    if len(argv) == 0 or argv[0].startswith('-'):
+        # general options, it exits after printing help or version
+        from docopt import docopt
+        docopt(main_doc,
+               version='clipon version %s' % __version__,
+               options_first=True,
+               argv=argv)
+        return
+
+    cmd = argv[0]
 
     if cmd == 'help':
-        do_help(argv)
+        do_help(argv[1:])
         return
 
     try:
         # parse the options for subcommand
         cmd_doc_name = cmd + '_doc'
         cmd_doc = globals()[cmd_doc_name]
-        args = docopt(cmd_doc, argv)
+        args = parse_args(cmd_doc, argv)
 
         # call the subcommand handler
         method_name = 'do_' + cmd
@@ -11,21 +11,30 @@ import threading
 import dbus
 import dbus.service
 from dbus.mainloop.glib import DBusGMainLoop
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import GLib, Gtk, Gdk, GObject
+from gi.repository import GLib, GObject
 from history import ClipHistory, ClipEntry
-from helper import init_log, logger, INT_MAX
+from transport import TransportServer, get_socket_path
+from filters import FilterPipeline, SECRET_ACTIONS
+from helper import init_log, logger, INT_MAX, get_runtime_dir
 from defines import *
 
 def clipon_dbus_method(name):
     return (CLIPON_BUS_NAME + '.' +  name)
 
+EXPIRE_INTERVAL = 60 #seconds between checks for expired entries
+EXPIRE_BATCH = 1000 #max number of entries expired in one go
+PRIMARY_DEBOUNCE = 500 #milliseconds for the primary selection to settle
+SIGNAL_PREVIEW = 128 #characters of a new clip sent along its signal
+
 """
 Clipon daemon creates two threads. One for monitoring
 the clipboard change and save the clipboard content.
 Another one for servicing requests from clients through
 DBus mechanism.
+
+Without a display, or if started with --headless, the daemon doesn't
+load Gtk at all. Clips are then pushed through the add_clip method or
+written to a FIFO instead.
 """
 
 class CliponConfig():
@@ -35,11 +44,21 @@ class CliponConfig():
     cfg = {
         'autosave': True,
         'max_entry':INT_MAX,
-        'max_length':INT_MAX
+        'max_length':INT_MAX,
+        'max_age':INT_MAX,
+        'socket': True,
+        'follow': '',
+        'secrets': 'off',
+        'primary': False
+        }
+    # values allowed for options of a few values
+    choices = {
+        'secrets': SECRET_ACTIONS,
         }
 
     table = {}
     cfg_file = None
+    pending = 0 #depth of transactions, saved when the outermost ends
 
     def __init__(self, cfg_file):
         self.cfg_file = cfg_file
@@ -47,7 +66,37 @@ class CliponConfig():
 
     def set_value(self, key, value):
         self.cfg[key] = value
-        self.save()
+        if self.pending == 0:
+            self.save()
+
+    def begin(self):
+        """
+        Start a transaction, values set until commit() are saved once
+        """
+        self.pending += 1
+
+    def commit(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.save()
+
+    def check(self, key, value):
+        """
+        Whether the value is of the type of the default value of the key,
+        numbers shall be greater than zero and strings of a few values
+        one of them
+        """
+        default = self.cfg.get(key, None)
+        if key in self.choices:
+            return value in self.choices[key]
+        if isinstance(default, bool):
+            return isinstance(value, bool)
+        if isinstance(default, int):
+            return isinstance(value, int) and not isinstance(value, bool) \
+                and value > 0
+        if isinstance(default, str):
+            return isinstance(value, str)
+        return False
 
     def get_value(self, key):
         return self.cfg.get(key, None)
@@ -67,31 +116,37 @@ class CliponConfig():
 
         fd = open(path, encoding='utf-8')
         cfg = json.load(fd)
-        logger.info("Loaded cfg:\n" + str(cfg))
+        logger.debug("Loaded cfg: %s", cfg)
         for k, v in cfg.items():
             self.cfg[k] = v
 
     def save(self):
+        # written to a temporary file then renamed, so that the file is
+        # either the old or the new one after a crash
         path = self.cfg_file
-        fd = open(path, 'w', encoding='utf-8')
-        json.dump(self.cfg, fd)
-        logger.info("Saved cfg:\n" + str(self.cfg))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fd:
+            json.dump(self.cfg, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_path, path)
+        logger.debug("Saved cfg: %s", self.cfg)
 
-class ClipboardMonitor(threading.Thread):
+class ClipSource(threading.Thread):
     """
-    Monitor the change of clipboard and save the content
+    Source of clips added to the history, which can be paused
     """
-    clipboard = None
+    kind = None
     history = None
+    filters = None # pipeline the clips go through, if any
     paused = False
 
     def __init__(self, history):
         threading.Thread.__init__(self)
-        self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
         self.history = history
 
     def stop(self):
-        Gtk.main_quit()
+        pass
 
     def pause(self):
         self.paused = True
@@ -99,8 +154,76 @@ class ClipboardMonitor(threading.Thread):
     def resume(self):
         self.paused = False
 
+    def push(self, text, source = None):
+        """
+        Add a clip to the history unless paused, return whether added.
+        Source is the selection it's captured from, if any.
+        """
+        if self.paused or not text:
+            return False
+        if self.filters is not None:
+            self.filters.submit(text, source)
+        else:
+            self.history.add_text(text, source)
+        return True
+
+class ClipboardMonitor(ClipSource):
+    """
+    Monitor the change of clipboard and save the content
+
+    The primary selection can be monitored as well. It changes all along
+    a selection being made with the mouse, so it's only read once it
+    hasn't changed for PRIMARY_DEBOUNCE.
+    """
+    kind = 'gtk'
+    clipboard = None
+    primary = None
+    primary_handler = None
+    primary_timer = 0
+
+    def __init__(self, history):
+        ClipSource.__init__(self, history)
+        # Gtk is heavy to load, only import it when monitoring
+        import gi
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk, Gdk
+        self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        self.primary = Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY)
+
+    def watch_primary(self, enable):
+        # handlers are changed from the loop dispatching them
+        GLib.idle_add(self.connect_primary, enable)
+
+    def connect_primary(self, enable):
+        if enable and self.primary_handler is None:
+            self.primary_handler = self.primary.connect('owner-change',
+                                                        self.on_primary_change)
+        elif not enable and self.primary_handler is not None:
+            self.primary.disconnect(self.primary_handler)
+            self.primary_handler = None
+            if self.primary_timer:
+                GLib.source_remove(self.primary_timer)
+                self.primary_timer = 0
+        return False
+
+    def on_primary_change(self, *args):
+        if self.primary_timer:
+            GLib.source_remove(self.primary_timer)
+        self.primary_timer = GLib.timeout_add(PRIMARY_DEBOUNCE, self.check_primary)
+
+    def check_primary(self):
+        self.primary_timer = 0
+        if not self.paused:
+            self.push(self.primary.wait_for_text(), 'primary')
+        return False
+
+    def stop(self):
+        from gi.repository import Gtk
+        Gtk.main_quit()
+
     def run(self):
         logger.info("Clipboard monitor started")
+        from gi.repository import Gtk
         self.clipboard.connect('owner-change', self.check_clipboard)
         Gtk.main()
 
@@ -109,7 +232,74 @@ class ClipboardMonitor(threading.Thread):
             return
 
         text = self.clipboard.wait_for_text()
-        self.history.add_text(text)
+        self.push(text, 'clipboard')
+
+class HeadlessSource(ClipSource):
+    """
+    Source of clips without a display. Besides the add_clip method,
+    clips are read from a FIFO in the runtime directory, each ended by
+    a NUL character or by the last writer closing the FIFO. Writers
+    following each other quickly may be read as one, so clips shall be
+    ended by NUL in scripts. A trailing newline is dropped, as added by
+    echo.
+
+        $ printf 'hello\0' > $XDG_RUNTIME_DIR/clipon/clips.fifo
+    """
+    kind = 'headless'
+    path = None
+    stopped = False
+
+    def __init__(self, history):
+        ClipSource.__init__(self, history)
+        self.daemon = True
+        self.path = os.path.join(get_runtime_dir(), 'clips.fifo')
+
+    def stop(self):
+        self.stopped = True
+        # wake up the thread waiting for a writer
+        try:
+            os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+    def push_data(self, data):
+        text = data.decode('utf-8', 'replace')
+        if text.endswith('\n'):
+            text = text[:-1]
+        self.push(text)
+
+    def run(self):
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            os.mkfifo(self.path, 0o600)
+        except OSError as e:
+            logger.error("Failed to create %s: %s", self.path, e)
+            return
+        logger.info("Reading clips from %s", self.path)
+
+        while not self.stopped:
+            # blocks until a writer opens the FIFO
+            fd = os.open(self.path, os.O_RDONLY)
+            pending = b''
+            try:
+                while not self.stopped:
+                    data = os.read(fd, 65536)
+                    if len(data) == 0:
+                        break #all writers closed it
+                    clips = (pending + data).split(b'\0')
+                    pending = clips.pop()
+                    for clip in clips:
+                        self.push_data(clip)
+            finally:
+                os.close(fd)
+            if pending and not self.stopped:
+                self.push_data(pending)
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
 
 class CliponDaemon(threading.Thread, dbus.service.Object):
     """
@@ -124,9 +314,32 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
     cfg = None
     log_file = None
     lockf = None
-
-    def __init__(self):
+    transport = None
+    replica = None
+    filters = None
+    notify_fd = None
+    start_time = None
+    ready_time = None
+
+    def __init__(self, notify_fd = None, headless = False):
         threading.Thread.__init__(self)
+        self.notify_fd = notify_fd
+        self.headless = headless
+        self.start_time = time.time()
+
+    def notify(self, msg):
+        """
+        Tell the process who started the daemon whether it is ready to
+        service requests, by writing a line to the notify pipe
+        """
+        if self.notify_fd is None:
+            return
+        try:
+            os.write(self.notify_fd, (msg + '\n').encode('utf-8'))
+            os.close(self.notify_fd)
+        except OSError:
+            pass
+        self.notify_fd = None
 
     def setup(self):
         self.cfg_dir = GLib.get_user_config_dir()
@@ -138,6 +351,8 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
         data_dir = GLib.get_user_data_dir()
         data_dir = os.path.join(data_dir, 'clipon')
         self.log_file = os.path.join(data_dir, 'clipon.log')
+        self.replica_file = os.path.join(data_dir, 'replica.json')
+        self.filters_file = os.path.join(data_dir, 'filters.json')
         if not os.path.exists(data_dir):
             os.mkdir(data_dir, 0o700)
 
@@ -145,12 +360,17 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
 
     def run(self):
 
-        #lock a tmp file to avoid starting multiple daemons
-        self.lockf = open('/tmp/clipon-lock', 'w')
+        #lock a file to avoid starting multiple daemons in a session,
+        #daemons of other sessions have their own runtime directory
+        run_dir = get_runtime_dir()
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir, 0o700)
+        self.lockf = open(os.path.join(run_dir, 'clipon.lock'), 'w')
         try:
             fcntl.flock(self.lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except BlockingIOError:
             logger.error("Unable to lock file")
+            self.notify('ERROR Daemon is already running')
             return
 
         self.setup()
@@ -160,9 +380,29 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
         self.cfg.save()
 
         self.history = ClipHistory(self.cfg)
+        self.history.add_listener(self.on_history_event)
+
+        self.history.expire(EXPIRE_BATCH)
+        GLib.timeout_add_seconds(EXPIRE_INTERVAL, self.maintain_history)
+
+        self.cfg.set_method('socket', self.set_socket)
+        if self.cfg.get_value('socket'):
+            self.start_transport()
 
-        self.monitor = ClipboardMonitor(self.history)
+        self.cfg.set_method('follow', self.set_follow)
+        if self.cfg.get_value('follow'):
+            self.start_replica(self.cfg.get_value('follow'))
+
+        self.filters = FilterPipeline(self.history, self.cfg.get_value('secrets'),
+                                      self.filters_file)
+        self.cfg.set_method('secrets', self.set_secrets)
+
+        self.monitor = self.make_source()
+        self.monitor.filters = self.filters
         self.monitor.start()
+        self.cfg.set_method('primary', self.set_primary)
+        if self.cfg.get_value('primary') and isinstance(self.monitor, ClipboardMonitor):
+            self.monitor.watch_primary(True)
 
         dbus_loop = DBusGMainLoop()
         bus_name = dbus.service.BusName(CLIPON_BUS_NAME,
@@ -174,15 +414,130 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
         self.main_loop = GObject.MainLoop()
 
         self.status = 'active'
+        self.ready_time = time.time() - self.start_time
+        self.notify('READY')
         try:
-            logger.info("DBus service started")
+            logger.info("DBus service started in %.3f seconds", self.ready_time)
             self.main_loop.run()
         except (KeyboardInterrupt, SystemExit):
             self.stop()
 
+    def make_source(self):
+        if not self.headless:
+            if os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'):
+                try:
+                    return ClipboardMonitor(self.history)
+                except (ImportError, ValueError) as e:
+                    logger.error("Failed to load Gtk: %s", e)
+            logger.info("No display, running headless")
+        return HeadlessSource(self.history)
+
+    def maintain_history(self):
+        # commit recently saved entries, then expire old ones
+        self.sync()
+        if self.history.expire(EXPIRE_BATCH) > 0:
+            # expire the rest in batches, not to block the main loop
+            GLib.idle_add(self.expire_more)
+        return True
+
+    def sync(self):
+        # the position of the replica is acknowledged only once the
+        # entries merged up to it are committed
+        replica = self.replica
+        position = replica.position if replica is not None else None
+        self.history.sync()
+        if replica is not None:
+            try:
+                replica.save_position(position)
+            except OSError as e:
+                logger.error("Failed to save replica position: %s", e)
+
+    def expire_more(self):
+        return self.history.expire(EXPIRE_BATCH) > 0
+
+    def start_transport(self):
+        try:
+            self.transport = TransportServer(get_socket_path(), self.history)
+        except OSError as e:
+            logger.error("Failed to listen on socket: %s", e)
+            return False
+        self.transport.start()
+        return True
+
+    def stop_transport(self):
+        if self.transport is not None:
+            self.transport.stop()
+            self.transport = None
+
+    def start_replica(self, leader):
+        from replica import Replicator
+        self.replica = Replicator(self.history, leader, self.replica_file)
+        self.replica.start()
+
+    def stop_replica(self):
+        if self.replica is not None:
+            self.replica.stop()
+            self.sync()
+            self.replica = None
+
+    def set_follow(self, leader):
+        """
+        Follow the history of the daemon listening on the socket path
+        given, or stop following if it's empty
+        """
+        leader = str(leader)
+        if leader and self.transport is not None and \
+                os.path.abspath(leader) == self.transport.server_address:
+            logger.error("Daemon can't follow itself")
+            return False
+        self.stop_replica()
+        if leader:
+            self.start_replica(leader)
+        self.cfg.set_value('follow', leader)
+        return True
+
+    def set_secrets(self, action):
+        """
+        Redact or drop clips with secrets, or turn it off. Custom filters
+        are reloaded as well.
+        """
+        action = str(action)
+        if action not in SECRET_ACTIONS:
+            return False
+        self.filters.configure(action)
+        self.cfg.set_value('secrets', action)
+        return True
+
+    def set_primary(self, enable):
+        """
+        Capture the primary selection besides the clipboard
+        """
+        enable = bool(enable)
+        if enable and not isinstance(self.monitor, ClipboardMonitor):
+            logger.error("No primary selection without a display")
+            return False
+        if isinstance(self.monitor, ClipboardMonitor):
+            self.monitor.watch_primary(enable)
+        self.cfg.set_value('primary', enable)
+        return True
+
+    def set_socket(self, enable):
+        enable = bool(enable)
+        if enable and self.transport is None:
+            if not self.start_transport():
+                return False
+        elif not enable:
+            self.stop_transport()
+        self.cfg.set_value('socket', enable)
+        return True
+
     @dbus.service.method(clipon_dbus_method('stop'))
     def stop(self):
+        self.stop_replica()
+        self.sync()
+        self.stop_transport()
         self.monitor.stop()
+        self.filters.stop()
         self.main_loop.quit()
         fcntl.flock(self.lockf, fcntl.LOCK_UN)
         logger.info("DBus service stopped")
@@ -199,14 +554,118 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
         self.monitor.resume()
         logger.info("Resumed clipboard monitor")
 
+    @dbus.service.method(clipon_dbus_method('add_clip'))
+    def add_clip(self, text):
+        """
+        Add a clip as if it was copied, unless paused
+        """
+        return self.monitor.push(str(text))
+
+    @dbus.service.method(clipon_dbus_method('add_clips'), in_signature='a(sd)')
+    def add_clips(self, clips):
+        """
+        Add a batch of (text, time) clips in one transaction, time being
+        0 for now, times in the future are taken as now. Entries are put
+        in time order and those already in history are skipped. Return
+        the number of clips added.
+        """
+        clips = [(str(text), float(t) if t > 0 else None) for text, t in clips]
+        return self.history.add_texts(clips)
+
     @dbus.service.method(clipon_dbus_method('get_clip_entry'))
     def get_clip_entry(self, index):
-        entry = self.history.get_entry(index)
-        if entry is not None:
-            return json.dumps(entry.info())
+        info = self.history.get_info(index)
+        if info is not None:
+            return json.dumps(info)
+        else:
+            return None
+
+    @dbus.service.method(clipon_dbus_method('get_clip_range'))
+    def get_clip_range(self, index, start, end):
+        """
+        Same as get_clip_entry but only the slice [start, end) of the
+        text is read and returned. Negative end means to the end.
+        """
+        if end < 0:
+            end = INT_MAX
+        info = self.history.get_info(index, start, end)
+        if info is not None:
+            return json.dumps(info)
         else:
             return None
 
+    @dbus.service.method(clipon_dbus_method('search_history'))
+    def search_history(self, query, limit):
+        found = []
+        for index, entry in self.history.search(query, limit):
+            info = self.history.get_info(index)
+            info['index'] = index
+            found.append(info)
+        return json.dumps(found)
+
+    @dbus.service.method(clipon_dbus_method('pin'))
+    def pin(self, index):
+        return self.history.pin(index)
+
+    @dbus.service.method(clipon_dbus_method('unpin'))
+    def unpin(self, index):
+        return self.history.unpin(index)
+
+    @dbus.service.method(clipon_dbus_method('get_pinned'))
+    def get_pinned(self):
+        """
+        Return in JSON the indexes of pinned entries, oldest first
+        """
+        return json.dumps(self.history.pinned_indexes())
+
+    @dbus.service.method(clipon_dbus_method('pick'))
+    def pick(self, query, top, preview):
+        """
+        Return in JSON at most top entries best matching the query,
+        with their text sliced to preview characters. Negative preview
+        means the whole text.
+        """
+        if preview < 0:
+            preview = INT_MAX
+        found = []
+        for index, score in self.history.pick(query, top):
+            found.append({'index': index, 'score': score,
+                          'text': self.history.get_text(index, 0, preview)})
+        return json.dumps(found)
+
+    @dbus.service.method(clipon_dbus_method('use_clip'))
+    def use_clip(self, index):
+        return self.history.use_entry(index)
+
+    @dbus.service.method(clipon_dbus_method('group_similar'))
+    def group_similar(self, start, end):
+        """
+        Return in JSON the groups of near-duplicate entries in range
+        [start, end), each a list of indexes
+        """
+        return json.dumps(self.history.group_similar(start, end))
+
+    def on_history_event(self, event, index):
+        # history may be changed from the clipboard monitor thread,
+        # signals are emitted from the DBus main loop instead. Only a
+        # preview is sent, subscribers get the whole text if needed.
+        if event == 'added':
+            entry = self.history.get_entry(index)
+            preview = self.history.get_text(index, 0, SIGNAL_PREVIEW)
+            if entry is not None and preview is not None:
+                GLib.idle_add(self.clip_added, index, entry.time,
+                              entry.length, preview)
+        else:
+            GLib.idle_add(self.history_changed, self.history.size())
+
+    @dbus.service.signal(clipon_dbus_method('clip_added'), signature='idts')
+    def clip_added(self, index, time, length, preview):
+        pass
+
+    @dbus.service.signal(clipon_dbus_method('history_changed'), signature='i')
+    def history_changed(self, size):
+        pass
+
     @dbus.service.method(clipon_dbus_method('del_history'))
     def del_history(self, start, end):
         return self.history.del_range(start, end)
@@ -231,8 +690,30 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
         info['Configure file'] = self.cfg_file
         info['History Info'] = history_info
         info['Log file'] = self.log_file
+        info['Startup time'] = self.ready_time
+        info['Clip source'] = self.monitor.kind
+        if isinstance(self.monitor, HeadlessSource):
+            info['Clip FIFO'] = self.monitor.path
+        if self.transport is not None:
+            info['Socket file'] = self.transport.server_address
+        if self.replica is not None:
+            info['Replica'] = self.replica.info()
+        info['Filters'] = self.filters.info()
+        info['Filters file'] = self.filters_file
         return json.dumps(info)
 
+    @dbus.service.method(clipon_dbus_method('get_stats'))
+    def get_stats(self, top, preview):
+        """
+        Return aggregates of the history in JSON, along with a preview
+        of the given length for each of the most repeated clips
+        """
+        import stats # numpy is slow to load, only when requested
+        result = stats.history_stats(self.history, top)
+        result['repeated'] = [(index, count, self.history.get_text(index, 0, preview))
+                              for index, count in result['repeated']]
+        return json.dumps(result)
+
     @dbus.service.method(clipon_dbus_method('get_status'))
     def get_status(self):
         return self.status
@@ -241,14 +722,49 @@ class CliponDaemon(threading.Thread, dbus.service.Object):
     def config(self, key, value):
         method = self.cfg.get_method(key)
         if method is None:
-            logger.error("No method for key %s" % key)
+            logger.error("No method for key %s", key)
             return False
 
-        logger.info("Setting option %s to value %s" % (key, value))
+        logger.info("Setting option %s to value %s", key, value)
         return method(value)
 
-def main():
-    daemon = CliponDaemon()
+    @dbus.service.method(clipon_dbus_method('set_config'))
+    def set_config(self, values):
+        """
+        Set several options given as a JSON object at once. All values
+        are checked before any is applied, options of the history are
+        applied together, and the configure file is written once.
+        """
+        values = json.loads(values)
+        for key, value in values.items():
+            if self.cfg.get_method(key) is None or not self.cfg.check(key, value):
+                logger.error("Invalid value %s for option %s", value, key)
+                return False
+
+        logger.info("Setting options %s", values)
+        history_keys = ('autosave', 'max_entry', 'max_length', 'max_age')
+        self.cfg.begin()
+        try:
+            ret = self.history.configure({k: v for k, v in values.items()
+                                          if k in history_keys})
+            for key, value in values.items():
+                if key not in history_keys:
+                    ret = self.cfg.get_method(key)(value) and ret
+        finally:
+            self.cfg.commit()
+        return ret
+
+def main(argv=None):
+    notify_fd = None
+    headless = False
+    for arg in argv or sys.argv[1:]:
+        # file descriptor of the pipe for readiness notification
+        if arg.startswith('--notify-fd='):
+            notify_fd = int(arg[len('--notify-fd='):])
+        elif arg == '--headless':
+            headless = True
+
+    daemon = CliponDaemon(notify_fd, headless)
     daemon.start()
     print("Daemon started")
 
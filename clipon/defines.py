@@ -1,8 +1,11 @@
 """
 Global definitions
 """
+import sys
 
 CLIPON_VERSION='1.0.0'
 CLIPON_BUS_NAME='org.gtk.clipon'
 CLIPON_OBJ_PATH='/org/gtk/clipon'
 
+
+INT_MAX = sys.maxsize
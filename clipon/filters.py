@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import re
+import json
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from time import perf_counter
+from helper import logger
+
+"""
+Filters of captured clips
+
+Clips captured are passed through a pipeline of stages before being
+added to the history: they're cut to the maximum length, then searched
+for secrets like tokens, passwords or private keys, which are redacted
+or cause the clip to be dropped. The patterns of a stage are combined
+into one precompiled regex, so a clip is scanned once per stage whatever
+the number of patterns.
+
+The pipeline runs in a pool of worker processes, not to add latency to
+the capture nor to hold the GIL of the daemon while scanning. Clips are
+added in the order they were captured. A clip not filtered within
+FILTER_BUDGET seconds by a worker is dropped rather than added
+unfiltered, and the worker is killed and replaced, so a pattern too
+slow for a clip doesn't stall the clips after it. Time spent and
+matches are counted per stage and pattern.
+
+Besides the built-in patterns enabled by the 'secrets' option, custom
+ones are read from filters.json in the data directory, a list of
+objects like {"name": "ticket", "pattern": "TICKET-\\d+", "action":
+"redact"}, where action is redact or drop.
+"""
+
+FILTER_WORKERS = 2
+FILTER_BUDGET = 1.0 #seconds for a clip to be filtered
+
+SECRET_ACTIONS = ('off', 'redact', 'drop')
+FILTER_ACTIONS = ('redact', 'drop')
+
+SECRET_PATTERNS = [
+    ('private_key', r'-----BEGIN (?:[A-Z0-9]+ )*PRIVATE KEY-----'
+                    r'[\s\S]*?(?:-----END (?:[A-Z0-9]+ )*PRIVATE KEY-----|\Z)'),
+    ('aws_key', r'\b(?:AKIA|ASIA)[0-9A-Z]{16}\b'),
+    ('github_token', r'\b(?:gh[pousr]_[A-Za-z0-9]{36,}|github_pat_[A-Za-z0-9_]{40,})'),
+    ('slack_token', r'\bxox[abprs]-[A-Za-z0-9-]{10,}'),
+    ('jwt', r'\beyJ[A-Za-z0-9_-]{8,}\.[A-Za-z0-9_-]{8,}\.[A-Za-z0-9_-]{8,}'),
+    ('password', r'(?i:\b(?:password|passwd|pwd|secret|api[_-]?key|token)'
+                 r'\s*[:=]\s*)\S+'),
+]
+
+class Stage:
+    """
+    Patterns of the same kind combined into one regex
+    """
+    name = None
+    rules = None
+    regex = None
+    names = None
+    actions = None
+
+    def __init__(self, name, rules):
+        """
+        Rules is a list of (name, pattern, action)
+        """
+        self.name = name
+        self.rules = rules
+        self.names = {}
+        self.actions = {}
+        groups = []
+        for i, (rule, pattern, action) in enumerate(rules):
+            # named groups shall be identifiers, the name is kept apart
+            group = 'g%d' % i
+            self.names[group] = rule
+            self.actions[group] = action
+            groups.append('(?P<%s>%s)' % (group, pattern))
+        self.regex = re.compile('|'.join(groups))
+        self.lock = threading.Lock() # for the counters
+        self.clips = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.matches = dict((rule[0], 0) for rule in rules)
+
+    def apply(self, text):
+        """
+        Return the text with matches redacted, or None if it's dropped,
+        and the rules matched
+        """
+        parts = []
+        pos = 0
+        found = []
+        for m in self.regex.finditer(text):
+            rule = self.names[m.lastgroup]
+            found.append(rule)
+            if self.actions[m.lastgroup] == 'drop':
+                parts = None
+                break
+            parts.append(text[pos:m.start()])
+            parts.append('[redacted %s]' % rule)
+            pos = m.end()
+
+        if parts is not None and pos > 0:
+            parts.append(text[pos:])
+            text = ''.join(parts)
+        elif parts is None:
+            text = None
+        return text, found
+
+    def count(self, elapsed, found):
+        """
+        Count a clip filtered in elapsed seconds, and the rules matched
+        """
+        with self.lock:
+            self.clips += 1
+            self.time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            for rule in found:
+                self.matches[rule] += 1
+
+    def info(self):
+        return {
+            'Clips': self.clips,
+            'Total ms': round(self.time * 1000, 3),
+            'Max ms': round(self.max_time * 1000, 3),
+            'Matches': self.matches,
+        }
+
+def load_rules(path):
+    """
+    Return the custom rules of a filters file, empty if there is none
+    or it is invalid
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            items = json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logger.error("Failed to load filters from %s: %s", path, e)
+        return []
+
+    rules = []
+    for item in items:
+        try:
+            name = str(item['name'])
+            pattern = item['pattern']
+            action = item.get('action', 'redact')
+            re.compile(pattern)
+        except (KeyError, TypeError, AttributeError, re.error) as e:
+            logger.error("Invalid filter %s: %s", item, e)
+            continue
+        if action not in FILTER_ACTIONS:
+            logger.error("Invalid action %s of filter %s", action, name)
+            continue
+        rules.append((name, pattern, action))
+    return rules
+
+def filter_text(stages, text):
+    """
+    Pass a text through the stages. Return the text, None if dropped,
+    and the (elapsed, found) of each stage it went through.
+    """
+    counts = []
+    for stage in stages:
+        begin = perf_counter()
+        text, found = stage.apply(text)
+        counts.append((perf_counter() - begin, found))
+        if text is None:
+            break
+    return text, counts
+
+def work(conn):
+    """
+    Main of a worker process, filtering texts received on the connection
+    with the stages last received along one
+    """
+    stages = []
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        specs, text = job
+        if specs is not None:
+            stages = [Stage(name, rules) for name, rules in specs]
+        conn.send(filter_text(stages, text))
+
+class FilterWorker:
+    """
+    Worker process filtering one clip at a time, killed and started
+    again when a clip takes too long
+    """
+    context = None
+    process = None
+    conn = None
+    stages = None # stages known by the process
+
+    def __init__(self, context):
+        self.context = context
+
+    def start(self):
+        self.conn, child = self.context.Pipe()
+        self.process = self.context.Process(target=work, args=(child,),
+                                            name='clipon-filter', daemon=True)
+        self.process.start()
+        child.close()
+        self.stages = None
+
+    def run(self, stages, text, timeout):
+        """
+        Return the result of filter_text() in the worker process, or
+        raise TimeoutError if it's not done within timeout seconds.
+        Rules of the stages are sent along the first text they filter.
+        """
+        if self.process is None:
+            self.start()
+        specs = None
+        if stages is not self.stages:
+            specs = [(stage.name, stage.rules) for stage in stages]
+        self.conn.send((specs, text))
+        self.stages = stages
+        if not self.conn.poll(timeout):
+            self.kill()
+            raise TimeoutError()
+        return self.conn.recv()
+
+    def kill(self):
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.process = None
+
+class FilterPipeline:
+    """
+    Filter clips in worker processes before adding them to the history
+    """
+    history = None
+    stages = None
+
+    def __init__(self, history, secrets = 'off', filters_file = None,
+                 workers = FILTER_WORKERS, budget = FILTER_BUDGET):
+        self.history = history
+        self.budget = budget
+        self.filters_file = filters_file
+        self.stages = []
+        self.dropped = 0
+        self.timeouts = 0
+        self.pending = deque() # (future, source) of clips in capture order
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.jobs = queue.Queue() # (future, text) of clips to be filtered
+        self.num_workers = workers
+        self.threads = None # started with the workers on first use
+        self.configure(secrets)
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def configure(self, secrets):
+        # workers are sent the new stages along the next clip, counters
+        # are kept here
+        stages = []
+        if secrets != 'off':
+            stages.append(Stage('secrets', [(name, pattern, secrets)
+                                            for name, pattern in SECRET_PATTERNS]))
+        if self.filters_file is not None:
+            rules = load_rules(self.filters_file)
+            if len(rules) > 0:
+                stages.append(Stage('custom', rules))
+        self.stages = stages
+
+    def start_workers(self):
+        # forked from a server process without threads, rather than
+        # from the daemon whose threads might hold locks
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in methods else 'spawn')
+        self.threads = []
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self.serve,
+                                      args=(FilterWorker(context),))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def serve(self, worker):
+        # feed a worker process with the clips queued, one at a time
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                worker.kill()
+                return
+            future, text = job
+            stages = self.stages
+            try:
+                text, counts = worker.run(stages, text, self.budget)
+            except TimeoutError as e:
+                future.set_exception(e)
+                continue
+            except Exception as e:
+                # the worker is in an unknown state, it's replaced
+                worker.kill()
+                future.set_exception(e)
+                continue
+
+            for stage, (elapsed, found) in zip(stages, counts):
+                stage.count(elapsed, found)
+            future.set_result(text)
+
+    def submit(self, text, source = None):
+        """
+        Queue a clip to be filtered and added, it returns at once
+        """
+        stages = self.stages
+        if len(stages) == 0:
+            self.history.add_text(text, source)
+            return
+
+        max_length = self.history.max_length
+        if len(text) > max_length:
+            text = text[:max_length]
+        future = Future()
+        with self.cond:
+            if self.stopped:
+                return
+            if self.threads is None:
+                self.start_workers()
+            self.jobs.put((future, text))
+            self.pending.append((future, source))
+            self.cond.notify()
+
+    def collect(self):
+        # clips are added in the order they were captured, whichever
+        # worker filters them
+        while True:
+            with self.cond:
+                while len(self.pending) == 0 and not self.stopped:
+                    self.cond.wait()
+                if len(self.pending) == 0:
+                    return
+                future, source = self.pending.popleft()
+
+            # workers give up on a clip once its budget is spent, the
+            # wait is bounded
+            try:
+                text = future.result()
+            except TimeoutError:
+                self.timeouts += 1
+                logger.error("Dropped a clip not filtered within %.1f seconds, "
+                             "check the patterns of %s", self.budget,
+                             self.filters_file)
+                continue
+            except Exception as e:
+                logger.error("Failed to filter a clip: %s", e)
+                continue
+
+            if text is None:
+                self.dropped += 1
+            elif len(text) > 0:
+                self.history.add_text(text, source)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+            threads = self.threads or []
+        self.collector.join(self.budget + 1)
+        for thread in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join(1)
+
+    def info(self):
+        return {
+            'Stages': dict((stage.name, stage.info()) for stage in self.stages),
+            'Dropped clips': self.dropped,
+            'Timed out clips': self.timeouts,
+        }
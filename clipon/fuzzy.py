@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import math
+
+"""
+Fuzzy matching of clips ranked by frecency
+
+A clip matches a query if the characters of the query appear in order
+in the beginning of its text, ignoring case. The match quality is in
+(0, 1], substrings are preferred to scattered characters, and matches
+close to the start to those far from it. The score of a clip is its
+match quality times its frecency, which grows with the number of times
+the clip was copied or used and decays with its age.
+
+To avoid reading texts, each entry has a mask of the characters in the
+beginning of its text, and entries whose mask doesn't cover the mask of
+the query are skipped. Another mask of the pairs of adjacent characters
+bounds the match quality: each pair of the query missing in the text is
+a gap of the match. Entries are scored in order of the bound of their
+score, in bulk with NumPy if it's available, or newest first otherwise,
+and scoring stops once no entry left could beat the top ones.
+"""
+
+MATCH_CHARS = 1024 #only the beginning of clips is matched
+HALF_LIFE = 86400 #seconds for frecency to drop by half
+DISTANCE_DECAY = 64 #characters for match quality to drop by half
+RANK_BATCH = 256 #entries ordered by their bound in one go
+
+numpy = None # imported on first use as it's slow to load, False if missing
+
+def char_mask(text):
+    """
+    Return a bitmask of the characters in the text, ignoring case. Bits
+    0-25 are for letters, 26-35 for digits and the others for the rest,
+    so it's never negative as a signed 64-bit integer.
+    """
+    mask = 0
+    for c in set(text[:MATCH_CHARS].lower()):
+        if 'a' <= c <= 'z':
+            mask |= 1 << (ord(c) - 97)
+        elif '0' <= c <= '9':
+            mask |= 1 << (ord(c) - 48 + 26)
+        elif not c.isspace():
+            mask |= 1 << (36 + ord(c) % 27)
+    return mask
+
+def pair_mask(text):
+    """
+    Return a bitmask of the pairs of adjacent characters in the text,
+    ignoring case, hashed to bits 0-62. It's 0 only if the text has no
+    pair, which is taken as unknown.
+    """
+    text = text[:MATCH_CHARS].lower()
+    mask = 0
+    for pair in set(zip(text, text[1:])):
+        mask |= 1 << ((ord(pair[0]) * 31 + ord(pair[1])) % 63)
+    return mask
+
+def quality_bound(query_pairs, length, pairs):
+    """
+    Return an upper bound of the quality of a query of the given length
+    and pairs, as a list of bits, matching a text of the given pair mask
+    """
+    if pairs == 0:
+        return 1.0
+    missing = sum(1 for bit in query_pairs if not pairs >> bit & 1)
+    if missing == 0:
+        return 1.0
+    return 0.5 * length / (length + missing)
+
+def get_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            module = False
+        numpy = module
+    return numpy
+
+def rank_candidates(query, masks, pairs, times, now, usage):
+    """
+    Yield (index, bound, rest) of the entries that may match the query,
+    whose masks cover the query or are unknown yet. bound is an upper
+    bound of the score of the entry, and rest one of the entries yielded
+    after it, given the highest usage of any clip. Masks, pairs and times
+    are arrays of the entries, which must not be changed meanwhile.
+    """
+    query_mask = char_mask(query)
+    query_pairs = pair_mask(query)
+    query_pairs = [bit for bit in range(63) if query_pairs >> bit & 1]
+    weight = 1 + math.log1p(usage)
+
+    np = get_numpy()
+    if not np:
+        for index in range(len(masks) - 1, -1, -1):
+            mask = masks[index]
+            if mask & query_mask != query_mask and mask != 0:
+                continue
+            rest = weight * 0.5 ** (max(now - times[index], 0) / HALF_LIFE)
+            yield index, rest * quality_bound(query_pairs, len(query),
+                                              pairs[index]), rest
+        return
+
+    view = np.frombuffer(masks, dtype=np.int64)
+    found = np.flatnonzero(((view & query_mask) == query_mask) | (view == 0))
+    found_pairs = np.frombuffer(pairs, dtype=np.int64)[found]
+    ages = now - np.frombuffer(times, dtype=np.float64)[found]
+    del view # arrays can be resized again once released
+
+    missing = np.zeros(len(found))
+    for bit in query_pairs:
+        missing += (found_pairs >> bit & 1) == 0
+    missing[found_pairs == 0] = 0
+    quality = np.where(missing == 0, 1.0,
+                       0.5 * len(query) / (len(query) + np.maximum(missing, 1)))
+    bounds = quality * weight * 0.5 ** (np.maximum(ages, 0) / HALF_LIFE)
+
+    # the best ones are ordered first, newest first among equal bounds,
+    # the rest only if scoring goes on
+    batch = RANK_BATCH
+    while len(found) > 0:
+        if len(found) > batch:
+            part = np.argpartition(-bounds, batch)
+            head, tail = part[:batch], part[batch:]
+        else:
+            head, tail = np.arange(len(found)), np.arange(0)
+        order = head[np.lexsort((-found[head], -bounds[head]))]
+        for index, bound in zip(found[order].tolist(), bounds[order].tolist()):
+            yield index, bound, bound
+        found, bounds = found[tail], bounds[tail]
+        batch *= 4
+
+def match_quality(query, text):
+    """
+    Return the quality of the lowercase query matching the lowercase
+    text, 0 if it doesn't match
+    """
+    if len(query) == 0:
+        return 1.0
+    start = text.find(query)
+    if start >= 0:
+        return 1.0 / (1 + start / DISTANCE_DECAY)
+
+    # characters of the query in order, taken as early as possible
+    start = text.find(query[0])
+    if start < 0:
+        return 0.0
+    pos = start
+    gaps = 0
+    for c in query[1:]:
+        found = text.find(c, pos + 1)
+        if found < 0:
+            return 0.0
+        gaps += found - pos - 1
+        pos = found
+    return 0.5 * len(query) / (len(query) + gaps) / (1 + start / DISTANCE_DECAY)
+
+def frecency(age, usage):
+    """
+    Return the weight of a clip copied or used usage times, and whose
+    latest copy is age seconds old
+    """
+    return (1 + math.log1p(usage)) * 0.5 ** (max(age, 0) / HALF_LIFE)
@@ -4,36 +4,121 @@
 from __future__ import absolute_import
 import sys
 import os
-import re
+import atexit
+import queue
+import threading
 import logging
 import logging.handlers
 from logging import Logger
-from xml.dom import minidom
-try:
-    import xml.etree.cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
-
-INT_MAX = sys.maxsize
+from defines import INT_MAX
 
 #create or get a logger with given name
 LOGGER_NAME = 'clipon'
 logger = logging.getLogger(LOGGER_NAME)
 
+LOG_QUEUE_SIZE = 4096 #records queued for the writer, newer ones dropped
+LOG_BURST = 10 #records of a message class logged per window
+LOG_WINDOW = 60 #seconds
+log_listener = None
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop records of a message class beyond LOG_BURST per LOG_WINDOW.
+    The class of a record is its format string, as arguments are given
+    apart. The first record after a window with drops tells how many.
+    """
+    def __init__(self, burst = LOG_BURST, window = LOG_WINDOW):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.window = window
+        self.counts = {} # (level, msg) -> [window start, count, dropped]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            return self.check(record)
+
+    def check(self, record):
+        key = (record.levelno, record.msg)
+        count = self.counts.get(key, None)
+        if count is None or record.created - count[0] >= self.window:
+            dropped = count[2] if count is not None else 0
+            if len(self.counts) > LOG_QUEUE_SIZE:
+                self.counts.clear() #not to grow with messages built on the fly
+            self.counts[key] = [record.created, 1, 0]
+            if dropped > 0:
+                record.msg = "%s (%d similar messages dropped)" % (
+                    record.getMessage(), dropped)
+                record.args = None
+            return True
+
+        count[1] += 1
+        if count[1] > self.burst:
+            count[2] += 1
+            return False
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Put records in a bounded queue, written to file by a background
+    thread, so that a slow disk never blocks the logging threads
+    """
+    dropped = 0
+
+    def prepare(self, record):
+        # formatted by the writer thread, not on the logging thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 def init_log(logfile):
-    global logger
-    logger.setLevel(logging.DEBUG)
+    global log_listener
 
-    # create a rotating file handler
+    # records below INFO are not even created
+    logger.setLevel(logging.INFO)
+
+    # create a rotating file handler, written by the listener thread
     h = logging.handlers.RotatingFileHandler(logfile, maxBytes=1024*1024)
-    h.setLevel(logging.INFO)
     fmt = '%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s'
     formatter = logging.Formatter(fmt, datefmt='%Y/%m/%d %H:%M:%S')
     h.setFormatter(formatter)
 
-    logger.addHandler(h)
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    qh = LogQueueHandler(q)
+    qh.addFilter(RateLimitFilter())
+    log_listener = logging.handlers.QueueListener(q, h)
+    log_listener.start()
+
+    logger.addHandler(qh)
+    # records still queued are written on exit
+    atexit.register(stop_log)
     logger.info("Initialized logger")
 
+def stop_log():
+    """
+    Write the records queued and stop the writer thread
+    """
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+def get_runtime_dir():
+    """
+    Directory of clipon in the user runtime directory, same as the one
+    returned by GLib.get_user_runtime_dir()
+    """
+    run_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not run_dir:
+        run_dir = os.environ.get('XDG_CACHE_HOME')
+    if not run_dir:
+        run_dir = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(run_dir, 'clipon')
+
 def open_file(dir_path, file_path, mode):
     fd = None
     if not os.path.isfile(file_path):
@@ -43,24 +128,70 @@ def open_file(dir_path, file_path, mode):
             if not os.path.exists(file_path):
                 open(file_path, 'x')
         except IOError:
-            logger.error("Failed to create file %s" % file_path)
+            logger.error("Failed to create file %s", file_path)
             return None
 
     try:
         fd = open(file_path, mode)
     except IOError:
-        logger.error("Failed to open file %s" % file_path)
+        logger.error("Failed to open file %s", file_path)
         return None
 
     return fd
 
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+def punch_hole(fd, offset, length):
+    """
+    Deallocate the given range of a file without changing its size or
+    moving the data after it. Return False if not supported.
+    """
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return False
+
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.c_int64, ctypes.c_int64]
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    if fallocate(fd, mode, offset, length) != 0:
+        logger.debug("fallocate failed: %s", os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+XML_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                             '"': '&quot;', '\n': '&#10;', '\r': '&#13;',
+                             '\t': '&#9;'})
+
+def format_element(lines, elem, indent):
+    attrs = ''.join([' %s="%s"' % (k, v.translate(XML_ESCAPES))
+                     for k, v in elem.items()])
+    text = elem.text.strip() if elem.text else ''
+    if len(elem) == 0 and len(text) == 0:
+        lines.append('%s<%s%s/>' % (indent, elem.tag, attrs))
+    elif len(elem) == 0:
+        lines.append('%s<%s%s>%s</%s>' % (indent, elem.tag, attrs,
+                                          text.translate(XML_ESCAPES), elem.tag))
+    else:
+        lines.append('%s<%s%s>' % (indent, elem.tag, attrs))
+        if len(text) > 0:
+            lines.append(indent + '  ' + text.translate(XML_ESCAPES))
+        for child in elem:
+            format_element(lines, child, indent + '  ')
+        lines.append('%s</%s>' % (indent, elem.tag))
+
 def format_pretty(elem):
     """
-    Return a pretty-printed XML string for the given element.
+    Return a pretty-printed XML string for the given element. It's
+    written line by line rather than parsed again by minidom, which
+    takes seconds for a large history.
     """
-    raw_string = ET.tostring(elem, encoding='utf-8')
-    s = raw_string.decode()
-    s = re.sub(' *\n *', '', s) # remove any newline and its surrounding white space
-    raw_string = s.encode(encoding="utf-8")
-    dom_string = minidom.parseString(raw_string)
-    return dom_string.toprettyxml(indent="  ")
+    lines = ['<?xml version="1.0" ?>']
+    format_element(lines, elem, '')
+    lines.append('')
+    return '\n'.join(lines)
@@ -4,11 +4,23 @@
 from __future__ import absolute_import
 import sys
 import os
+import threading
+import hashlib
+import bisect
+import mmap
+import shutil
+import struct
+import zlib
+import heapq
+from array import array
 from time import time as sys_time
 from gi.repository.GLib import get_user_data_dir
 import helper
 from helper import logger, INT_MAX, format_pretty
 from defines import CLIPON_VERSION
+from similar import simhash, SimilarIndex, MAX_CHARS as SIMHASH_CHARS
+from fuzzy import char_mask, pair_mask, match_quality, frecency
+from fuzzy import rank_candidates, MATCH_CHARS
 from xml.dom import minidom
 try:
     import xml.etree.cElementTree as ET
@@ -19,137 +31,964 @@ except ImportError:
 Manage clip history in both RAM and file
 """
 
+SELECTION_MERGE_WINDOW = 60 #seconds a partial selection can be replaced
+USAGE_REBUILD = 1024 #entries deleted at once for which usage is rebuilt
+
 class ClipHistory:
     """
     Manage clip history in RAM
     """
-    history = []
+    history = None
     ps_history = None
     cfg = None
+    listeners = None
+    lock = None
+    similar_index = None # built on first use, see get_similar_index()
+    usage = None # built on first use, see get_usage()
+    pinned = None
+    last_capture = None # (time, source, text) of the latest clip captured
+    log = None # built on first use, see get_log()
+    # cached values of configurations, not to look them up on capture
+    autosave = True
+    max_entry = INT_MAX
+    max_length = INT_MAX
+    max_age = INT_MAX
 
     def __init__(self, cfg):
         self.cfg = cfg
+        self.history = ClipIndex()
+        self.listeners = []
+        # (time, digest) of pinned entries, which are not deleted by
+        # pruning and expiring. Unlike indexes they don't change when
+        # older entries are deleted, and unlike times alone they tell
+        # apart entries added at the same time.
+        self.pinned = set()
+        # history is changed by the monitor thread and the DBus thread
+        self.lock = threading.RLock()
         self.cfg.set_method('autosave', self.set_autosave)
         self.cfg.set_method('max_length', self.set_max_length)
         self.cfg.set_method('max_entry', self.set_max_entry)
+        self.cfg.set_method('max_age', self.set_max_age)
+        self.autosave = cfg.get_value('autosave')
+        self.max_entry = cfg.get_value('max_entry')
+        self.max_length = cfg.get_value('max_length')
+        self.max_age = cfg.get_value('max_age')
         self.ps_history = PersistentHistory()
-        self.ps_history.load_all(self.history)
+        self.ps_history.load_all(self.history, self.pinned)
+        if not self.autosave:
+            # positions in the log are not saved, only valid for this run
+            self.ps_history.epoch = new_epoch()
 
     def add_entry(self, entry):
-        max_entry = self.cfg.get_value('max_entry')
-        if self.size() >= max_entry:
-            self.del_entry(0)
+        index = self.append_entry(entry)
+        self.notify('added', index)
+
+    def append_entry(self, entry):
+        with self.lock:
+            if self.size() >= self.max_entry:
+                self.del_head(self.size() - self.max_entry + 1)
 
-        self.history.append(entry)
-        if self.cfg.get_value('autosave'):
-            self.ps_history.save_entry(entry)
+            self.order_time(entry, self.size())
+            self.log_entry(entry)
+            if self.autosave:
+                if self.ps_history.save_entry(entry):
+                    # the data is read back from file when requested
+                    entry.data = None
+            self.history.append(entry)
+            self.index_similar(self.size() - 1, entry)
+            self.count_usage(entry.digest)
+            return self.size() - 1
 
-    def add_text(self, text):
-        max_length= self.cfg.get_value('max_length')
-        if len(text) > max_length:
-            text = text[0:max_length]
+    def order_time(self, entry, index):
+        """
+        Make the time of an entry put at index not earlier than the one
+        before, so that entries stay in time order when the system clock
+        steps backwards
+        """
+        if index > 0 and entry.time < self.history.times[index - 1]:
+            entry.time = self.history.times[index - 1]
+
+    def make_entry(self, text, time = None, fingerprint = True):
+        if len(text) > self.max_length:
+            text = text[0:self.max_length]
 
         #add a newline as separator
         text = text + '\n'
-        entry = ClipEntry(text)
-        self.add_entry(entry)
+        data = text.encode('utf-8')
+        return ClipEntry(data, time, length=len(data), digest=data_digest(data),
+                         simhash=simhash(text) if fingerprint else 0,
+                         mask=char_mask(text), pairs=pair_mask(text))
+
+    def add_text(self, text, source = None):
+        """
+        Add a captured clip. Given the selection it's captured from,
+        'clipboard' or 'primary', it's merged with the latest entry when
+        that one was just captured with the same text from the other
+        selection, or it's a partial primary selection this one extends.
+        """
+        entry = self.make_entry(text)
+        if source is None:
+            self.add_entry(entry)
+            return
+
+        with self.lock:
+            index = self.size() - 1
+            last = self.last_capture
+            if last is None or index < 0 or self.history.times[index] != last[0]:
+                last = None # the latest entry is not the one captured last
+
+            if last is not None and last[1] not in (source, 'both') \
+                    and self.history.digests[index] == entry.digest:
+                # the same text selected then copied, or the other way
+                # round, stored once, and not to be replaced by a
+                # primary selection anymore
+                self.last_capture = (last[0], 'both', text)
+                return
+
+            if last is not None and source == 'primary' and last[1] == source \
+                    and entry.time - last[0] < SELECTION_MERGE_WINDOW \
+                    and (text.startswith(last[2]) or text.endswith(last[2])):
+                # a growing selection replaces the partial one in place
+                self.replace_entry(index, entry)
+                event = 'changed'
+            else:
+                index = self.append_entry(entry)
+                event = 'added'
+            # the time of the entry as added, see order_time()
+            self.last_capture = (entry.time, source, text)
+
+        self.notify(event, index)
+
+    def replace_entry(self, index, entry):
+        with self.lock:
+            self.forget_usage(index, index + 1)
+            self.forget_pinned(index, index + 1)
+            self.order_time(entry, index)
+            self.log_entry(entry)
+            if self.autosave:
+                if self.ps_history.replace_entry(index, entry):
+                    entry.data = None
+            self.history.update(index, entry)
+            self.index_similar(index, entry)
+            self.count_usage(entry.digest)
+
+    def add_texts(self, clips):
+        """
+        Add a batch of clips given as (text, time) pairs, time being None
+        for now. They are merged at their place in time order, those
+        already in history are skipped, and the history file is
+        committed once for all. Times in the future are taken as now,
+        not to put the clips captured next before them. Return the
+        number of clips added.
+        """
+        # fingerprints are the most costly part, they are computed once
+        # near-duplicates are looked up, see fill_simhashes()
+        now = sys_time()
+        entries = [self.make_entry(text, now if time is None else min(time, now), False)
+                   for text, time in clips]
+        entries.sort(key=lambda e: e.time)
+        seen = set()
+        batch = []
+        with self.lock:
+            for entry in entries:
+                key = (entry.time, entry.digest)
+                if key not in seen and self.find_entry(*key) is None:
+                    seen.add(key)
+                    batch.append(entry)
+            written = self.autosave
+
+        # records are written without holding the lock, not to stall
+        # the capture meanwhile
+        ps_history = self.ps_history
+        ps_history.begin()
+        try:
+            if written:
+                for entry in batch:
+                    if not ps_history.write_record(entry):
+                        break
+            with self.lock:
+                num = self.merge_entries(batch)
+        finally:
+            ps_history.commit()
+
+        # one event for all, not to flood listeners
+        if num > 0:
+            self.notify('changed')
+        return num
+
+    def merge_entries(self, entries):
+        """
+        Merge entries sorted by time into history in one pass, skipping
+        those in history already. Those with an offset have their record
+        written to the data file. Return the number of entries merged.
+        """
+        ps_history = self.ps_history
+        size = self.size()
+        num = 0
+        for entry in entries:
+            if self.find_entry(entry.time, entry.digest, size) is not None:
+                # added meanwhile
+                if entry.offset >= 0:
+                    ps_history.dead_ranges.append((entry.offset - RECORD_HEADER.size,
+                                                   entry.offset + entry.length))
+                continue
+
+            self.log_entry(entry)
+            if self.autosave:
+                if entry.offset >= 0 or ps_history.write_record(entry):
+                    ps_history.add_meta(entry)
+                    ps_history.unsynced += 1
+                    entry.data = None
+            else:
+                entry.offset = -1 # data kept in RAM until saved
+            self.history.append(entry)
+            self.index_similar(self.size() - 1, entry)
+            self.count_usage(entry.digest)
+            num += 1
+
+        times = self.history.times
+        if num > 0 and size > 0 and times[size] < times[size - 1]:
+            # entries are appended after the old ones, then all are
+            # sorted at once, which is linear for two sorted runs.
+            # Entries of the same time keep their order, older first.
+            order = sorted(range(self.size()), key=times.__getitem__)
+            self.history.reorder(order)
+            self.similar_index = None # rows have moved
+            if self.autosave:
+                ps_history.meta_man.reorder(order)
+                offsets = self.history.offsets
+                ps_history.in_file_order = ps_history.in_file_order and \
+                    all(offsets[i - 1] < offsets[i] for i in range(1, len(offsets)))
+
+        if self.size() > self.max_entry:
+            self.del_head(self.size() - self.max_entry)
+        return num
+
+    def find_entry(self, time, digest, end = None):
+        """
+        Return the index of the entry of the given time and digest, or
+        None if there is none
+        """
+        times = self.history.times
+        if end is None:
+            end = len(times)
+        index = bisect.bisect_left(times, time, 0, end)
+        while index < end and times[index] == time:
+            if self.history.digests[index] == digest:
+                return index
+            index += 1
+        return None
+
+    def merge(self, entry):
+        """
+        Insert an entry replicated from another daemon at its place in
+        time order. Entries are identified by their time and digest, so
+        an entry already in history is not added again. Return whether
+        it's added.
+        """
+        if entry.data is not None:
+            text = str(entry.data, 'utf-8', 'ignore')
+            if entry.simhash == 0:
+                entry.simhash = simhash(text)
+            if entry.mask == 0:
+                entry.mask = char_mask(text)
+                entry.pairs = pair_mask(text)
+
+        with self.lock:
+            index = self.insert_entry(entry)
+            if index is None:
+                return False
+            appended = index == self.size() - 1
+
+        if appended:
+            self.notify('added', index)
+        else:
+            self.notify('changed')
+        return True
+
+    def insert_entry(self, entry):
+        """
+        Insert an entry after those not later than it, unless it's in
+        history already. Return its index, or None if not inserted.
+        """
+        with self.lock:
+            times = self.history.times
+            index = bisect.bisect_left(times, entry.time)
+            while index < self.size() and times[index] == entry.time:
+                if self.history.digests[index] == entry.digest:
+                    return None
+                index += 1
+
+            if self.size() >= self.max_entry:
+                num = self.size() - self.max_entry + 1
+                if index < num:
+                    return None #older than what would be kept
+                self.del_head(num)
+                index = bisect.bisect_right(self.history.times, entry.time)
+
+            self.log_entry(entry)
+            if self.autosave:
+                if self.ps_history.save_entry(entry, index):
+                    entry.data = None
+            self.history.insert(index, entry)
+            if index < self.size() - 1:
+                self.similar_index = None # rows have moved
+            self.index_similar(index, entry)
+            self.count_usage(entry.digest, entry.uses)
+            return index
+
+    @property
+    def log_epoch(self):
+        """
+        Identifier of the positions in the log, which changes when
+        positions handed out might have been lost
+        """
+        return self.ps_history.epoch
+
+    def get_log(self):
+        """
+        Return the log of entries in the order they were added, as
+        arrays of their positions, times and digests. It's built on
+        first use from the positions saved with the entries, then
+        entries are appended as they are added, wherever they're
+        inserted in time order.
+        """
+        with self.lock:
+            if self.log is None:
+                self.fill_digests()
+                history = self.history
+                order = sorted(range(self.size()), key=history.seqs.__getitem__)
+                self.log = (array('q', [history.seqs[i] for i in order]),
+                            array('d', [history.times[i] for i in order]),
+                            array('q', [history.digests[i] for i in order]))
+            return self.log
+
+    def log_entry(self, entry):
+        """
+        Give an entry being added the next position in the log, before
+        it's saved along with it
+        """
+        ps_history = self.ps_history
+        entry.seq = ps_history.next_seq
+        ps_history.next_seq += 1
+        log = self.log
+        if log is None:
+            return
+        log[0].append(entry.seq)
+        log[1].append(entry.time)
+        log[2].append(entry.digest)
+
+    def entries_logged(self, seq, limit = INT_MAX):
+        """
+        Return (seq, entry) of the entries still in history among at
+        most limit ones logged from the position seq on, and the
+        position after them
+        """
+        with self.lock:
+            seqs, times, digests = self.get_log()
+            start = bisect.bisect_left(seqs, seq)
+            stop = min(len(seqs), start + limit)
+            found = []
+            for i in range(start, stop):
+                index = self.find_entry(times[i], digests[i])
+                if index is not None:
+                    found.append((seqs[i], self.history[index]))
+            end = seqs[stop - 1] + 1 if stop > start else seq
+            return found, end
 
     def del_entry(self, index):
-        self.history.pop(index)
-        if self.cfg.get_value('autosave'):
-            self.save()
+        with self.lock:
+            self.forget_usage(index, index + 1)
+            self.forget_pinned(index, index + 1)
+            self.forget_similar(index, index + 1)
+            self.history.delete(index, index + 1)
+            if self.autosave:
+                self.save()
+        self.notify('changed')
 
     def del_range(self, start, end):
         if start < 0 or start >= self.size() or start > end:
             return
 
-        if end > self.size():
-            end = self.size()
+        if start == 0 and len(self.pinned_indexes(0, end)) == 0:
+            # deleted by user, unlike expired entries they shall not
+            # show up again after a crash
+            self.del_head(end)
+            self.sync()
+            return
+
+        with self.lock:
+            if end > self.size():
+                end = self.size()
+
+            self.forget_usage(start, end)
+            self.forget_pinned(start, end)
+            self.forget_similar(start, end)
+            self.history.delete(start, end)
+            if self.autosave:
+                self.save()
+        self.notify('changed')
+
+    def del_head(self, num):
+        """
+        Delete the oldest num entries, except pinned ones. Unlike
+        deleting other ranges, the history file is not rewritten.
+        """
+        with self.lock:
+            # pinned entries among the oldest are kept, and as many
+            # newer ones are deleted instead
+            end = min(num, self.size())
+            keep = []
+            for index in self.pinned_indexes(0, self.size()):
+                if index >= end:
+                    break
+                keep.append(index)
+                end = min(end + 1, self.size())
+            if end - len(keep) <= 0:
+                return
 
-        self.history = self.history[0:start] + self.history[end:self.size()]
-        if self.cfg.get_value('autosave'):
-            self.save()
+            # delete the runs of entries between the kept ones, last first
+            for start, stop in reversed(list(zip([-1] + keep, keep + [end]))):
+                self.forget_usage(start + 1, stop)
+                self.forget_similar(start + 1, stop)
+                self.history.delete(start + 1, stop)
+            if self.autosave:
+                self.ps_history.delete_head(end, keep)
+        self.notify('changed')
+
+    def expire(self, batch = INT_MAX):
+        """
+        Delete at most batch entries older than max_age, and return the
+        number of expired entries left
+        """
+        max_age = self.max_age
+        if max_age is None or max_age >= INT_MAX:
+            return 0
+
+        with self.lock:
+            # entries are in time order, find the first one to keep
+            cutoff = sys_time() - max_age
+            num = bisect.bisect_left(self.history.times, cutoff)
+            num -= len(self.pinned_indexes(0, num))
+            if num > 0:
+                self.del_head(min(num, batch))
+                logger.info("Expired %d entries", min(num, batch))
+            return max(num - batch, 0)
 
     def clear(self):
-        self.history.clear()
-        if self.cfg.get_value('autosave'):
-            self.ps_history.delete_all()
+        with self.lock:
+            self.history.clear()
+            self.similar_index = None
+            self.usage = None
+            self.pinned.clear()
+            if self.autosave:
+                self.ps_history.delete_all()
         logger.info("Cleared history")
+        self.notify('changed')
 
     def get_entry(self, index):
         entry = self.history[index] if index < len(self.history) else None
         return entry
 
+    def search(self, query, limit = INT_MAX):
+        """
+        Return (index, entry) pairs whose text contains the query,
+        newest first. The match is case insensitive.
+        """
+        query = query.lower()
+        found = []
+        for index in reversed(range(self.size())):
+            if len(found) >= limit:
+                break
+            text = self.get_text(index)
+            if text is not None and query in text.lower():
+                found.append((index, self.history[index]))
+        return found
+
+    def add_listener(self, listener):
+        """
+        Register a callable invoked as listener(event, index) when the
+        history changes. Event is 'added' with the index of the new
+        entry, or 'changed' with index None when entries were removed.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def notify(self, event, index = None):
+        for listener in self.listeners:
+            listener(event, index)
+
+    def get_text(self, index, start = 0, end = INT_MAX):
+        """
+        Return the slice [start, end) of the text of an entry. Entries
+        saved to file are not kept in RAM, only the requested slice is
+        read from file.
+        """
+        entry = self.get_entry(index)
+        if entry is None:
+            return None
+        if entry.data is not None:
+            if end < entry.length:
+                # as read from file, the cost is proportional to end
+                return str(entry.data[:end * 4], 'utf-8', 'ignore')[start:end]
+            return entry.text[start:end]
+        return self.ps_history.read_text(entry, start, end)
+
+    def get_data(self, index, start = 0, end = INT_MAX):
+        """
+        Return a memoryview of the bytes [start, end) of the UTF-8
+        encoded text of an entry, without decoding nor copying it
+        """
+        entry = self.get_entry(index)
+        if entry is None:
+            return None
+        if entry.data is not None:
+            return memoryview(entry.data)[start:end]
+        return self.ps_history.read_data(entry, start, end)
+
+    def get_info(self, index, start = 0, end = INT_MAX):
+        """
+        Return a dict of the entry with its text sliced to [start, end)
+        and the full length of the text in bytes
+        """
+        entry = self.get_entry(index)
+        if entry is None:
+            return None
+        text = self.get_text(index, start, end)
+        return {'time':entry.time, 'text':text, 'length':entry.length}
+
+    def fill_digests(self):
+        """
+        Compute the digest of entries loaded from file without one
+        """
+        digests = self.history.digests
+        if 0 not in digests:
+            return
+        for index in range(self.size()):
+            if digests[index] == 0:
+                data = self.get_data(index)
+                if data is not None:
+                    digests[index] = data_digest(data)
+
+    def fill_simhashes(self):
+        """
+        Compute the fingerprint of entries without one, those added in
+        bulk or saved by older versions. They are saved along with the
+        meta data at next checkpoint, not to be computed again.
+        """
+        simhashes = self.history.simhashes
+        if 0 not in simhashes:
+            return
+        for index in range(self.size()):
+            if simhashes[index] == 0:
+                text = self.get_text(index, 0, SIMHASH_CHARS)
+                if text is not None:
+                    simhashes[index] = simhash(text)
+                    if self.autosave:
+                        self.ps_history.set_simhash(index, simhashes[index])
+
+    def get_similar_index(self):
+        """
+        Return the index of fingerprints, which is built on first use
+        and kept up to date as entries are added
+        """
+        with self.lock:
+            if self.similar_index is None:
+                self.fill_simhashes()
+                self.similar_index = SimilarIndex(self.history.simhashes)
+            return self.similar_index
+
+    def index_similar(self, index, entry):
+        similar_index = self.similar_index
+        if similar_index is None:
+            return
+        if entry.simhash == 0 or similar_index.count > 2 * self.size() + 1024:
+            # rebuilt when needed, for too many entries were deleted
+            self.similar_index = None
+            return
+        similar_index.add(index, entry.simhash)
+
+    def forget_similar(self, start, end):
+        similar_index = self.similar_index
+        if similar_index is None:
+            return
+        if start == 0:
+            similar_index.del_head(min(end, self.size()))
+        else:
+            self.similar_index = None # rows have moved
+
+    def find_similar(self, index):
+        """
+        Return indexes of the near-duplicates of an entry, itself
+        included, oldest first
+        """
+        with self.lock:
+            similar_index = self.get_similar_index()
+            if index < 0 or index >= self.size():
+                return []
+            simhashes = self.history.simhashes
+            return sorted(similar_index.near(simhashes[index], simhashes))
+
+    def group_similar(self, start = 0, end = INT_MAX):
+        """
+        Group entries in range [start, end) with their near-duplicates
+        in the range. Return the groups as lists of indexes, oldest
+        first, and the groups are in order of their latest entry.
+        """
+        with self.lock:
+            similar_index = self.get_similar_index()
+            end = min(end, self.size())
+            start = max(start, 0)
+
+            # union find over distinct fingerprints in the range
+            parent = {}
+            for fingerprint in self.history.simhashes[start:end]:
+                parent[fingerprint] = fingerprint
+
+            def find(fingerprint):
+                while parent[fingerprint] != fingerprint:
+                    parent[fingerprint] = parent[parent[fingerprint]]
+                    fingerprint = parent[fingerprint]
+                return fingerprint
+
+            simhashes = self.history.simhashes
+            for fingerprint in parent:
+                for other in similar_index.near(fingerprint, simhashes):
+                    other = simhashes[other]
+                    if other in parent:
+                        a, b = find(fingerprint), find(other)
+                        if a != b:
+                            parent[a] = b
+
+            groups = {}
+            for index in range(start, end):
+                root = find(self.history.simhashes[index])
+                groups.setdefault(root, []).append(index)
+            return sorted(groups.values(), key=lambda group: group[-1])
+
+    def pin(self, index):
+        """
+        Pin an entry so that it's kept when older entries are pruned or
+        expired
+        """
+        with self.lock:
+            if index < 0 or index >= self.size():
+                return False
+            self.pinned.add(self.pin_key(index))
+            if self.autosave:
+                self.ps_history.set_pinned(index, True)
+        self.notify('changed')
+        return True
+
+    def unpin(self, index):
+        with self.lock:
+            if not self.is_pinned(index):
+                return False
+            self.pinned.discard(self.pin_key(index))
+            if self.autosave:
+                self.ps_history.set_pinned(index, False)
+        self.notify('changed')
+        return True
+
+    def is_pinned(self, index):
+        if index < 0 or index >= self.size():
+            return False
+        return self.pin_key(index) in self.pinned
+
+    def pin_key(self, index):
+        digests = self.history.digests
+        if digests[index] == 0:
+            data = self.get_data(index)
+            if data is not None:
+                digests[index] = data_digest(data)
+        return (self.history.times[index], digests[index])
+
+    def pinned_indexes(self, start = 0, end = INT_MAX):
+        """
+        Return indexes of pinned entries in range [start, end), in order
+        """
+        if len(self.pinned) == 0:
+            return []
+        with self.lock:
+            times = self.history.times
+            found = []
+            digests = self.history.digests
+            for t, digest in self.pinned:
+                index = bisect.bisect_left(times, t)
+                while index < self.size() and times[index] == t:
+                    if start <= index < end and digests[index] == digest:
+                        found.append(index)
+                    index += 1
+            return sorted(found)
+
+    def forget_pinned(self, start, end):
+        for index in self.pinned_indexes(start, end):
+            self.pinned.discard(self.pin_key(index))
+
+    def get_usage(self):
+        """
+        Return the number of times clips were copied and used by their
+        digest, which is built on first use and kept up to date as
+        entries are added, used and deleted
+        """
+        with self.lock:
+            if self.usage is None:
+                self.fill_digests()
+                self.usage = UsageIndex(self.history.digests, self.history.uses)
+            return self.usage
+
+    def count_usage(self, digest, uses = 0):
+        usage = self.usage
+        if usage is None:
+            return
+        usage.add(digest, uses)
+
+    def forget_usage(self, start, end):
+        usage = self.usage
+        if usage is None:
+            return
+        end = min(end, self.size())
+        if end - start > USAGE_REBUILD:
+            # rebuilt when needed, cheaper than removing each
+            self.usage = None
+            return
+        digests = self.history.digests
+        uses = self.history.uses
+        for index in range(start, end):
+            usage.remove(digests[index], uses[index])
+
+    def use_entry(self, index):
+        """
+        Record that an entry was used, e.g. pasted after being picked
+        """
+        with self.lock:
+            if index < 0 or index >= self.size():
+                return False
+            self.history.uses[index] += 1
+            if self.usage is not None:
+                self.usage.use(self.history.digests[index])
+            if self.autosave:
+                self.ps_history.set_uses(index, self.history.uses[index])
+        return True
+
+    def pick(self, query, top = 10):
+        """
+        Return (index, score) of at most top entries best matching the
+        query, best first. The latest copy of each clip is scored by
+        fuzzy matching the query, weighted by its frecency.
+        """
+        query = query.lower()
+        query_mask = char_mask(query)
+        now = sys_time()
+        best = [] # heap of (score, index)
+        seen = set() # digests of clips already scored
+        with self.lock:
+            usage = self.get_usage()
+            history = self.history
+            for index, bound, rest in rank_candidates(query, history.masks,
+                                                      history.pairs, history.times,
+                                                      now, usage.max_usage - 1):
+                if len(best) >= top:
+                    if rest <= best[0][0]:
+                        break #no entry left could do better
+                    if bound <= best[0][0]:
+                        continue
+
+                digest = history.digests[index]
+                if digest in seen:
+                    continue #older copy of a clip
+                seen.add(digest)
+
+                text = self.get_text(index, 0, MATCH_CHARS)
+                if text is None:
+                    continue
+                if history.masks[index] == 0:
+                    self.fill_masks(index, text)
+                    if query_mask & ~history.masks[index]:
+                        continue
+                quality = match_quality(query, text.lower())
+                if quality == 0:
+                    continue
+
+                score = quality * frecency(now - history.times[index],
+                                           usage[digest] - 1)
+                # newer entries win ties, as they're not scored first
+                if len(best) < top:
+                    heapq.heappush(best, (score, index))
+                elif (score, index) > best[0]:
+                    heapq.heapreplace(best, (score, index))
+
+        return [(index, score) for score, index in sorted(best, reverse=True)]
+
+    def fill_masks(self, index, text):
+        """
+        Set the masks of an entry loaded from file without them, they
+        are saved along with the meta data at next checkpoint
+        """
+        self.history.masks[index] = char_mask(text)
+        self.history.pairs[index] = pair_mask(text)
+        if self.autosave:
+            self.ps_history.set_masks(index, self.history.masks[index],
+                                      self.history.pairs[index])
+
     def size(self):
         return len(self.history)
 
     def info(self):
         info = {}
         info['size'] = self.size()
-        info['autosave'] = self.cfg.get_value('autosave')
-        info['max_length'] = self.cfg.get_value('max_length')
-        info['max_entry'] = self.cfg.get_value('max_entry')
+        info['autosave'] = self.autosave
+        info['max_length'] = self.max_length
+        info['max_entry'] = self.max_entry
+        info['max_age'] = self.max_age
+        info['pinned'] = len(self.pinned)
         ps_info = self.ps_history.info()
         for k, v in ps_info.items():
             info[k] = v
         return info
 
     def save(self, start = 0, end = INT_MAX):
-        if end == INT_MAX:
-            end = self.size()
+        """
+        Save entries in range [start, end) as the whole history file.
+        Records of entries already in the data file are reused, only
+        the others are appended, and the meta data is written once.
+        """
+        with self.lock:
+            if end == INT_MAX:
+                end = self.size()
 
-        if start < 0 or end > self.size() or start >= end:
-            return
+            if start < 0 or end > self.size() or start >= end:
+                return
 
-        # this looks not quite efficient, hopefully it will
-        # be rarely called in real use
-        self.ps_history.delete_all()
+            entries = [self.history[i] for i in range(start, end)]
+            for entry in entries:
+                entry.pinned = (entry.time, entry.digest) in self.pinned
+            # entries out of range still read their records from file
+            others = [self.history[i] for i in range(self.size())
+                      if (i < start or i >= end) and self.history.data[i] is None]
+            if not self.ps_history.save_all(entries, others):
+                return
 
-        hist = self.history[start:end]
-        for entry in hist:
-            self.ps_history.save_entry(entry)
+            for index, entry in zip(range(start, end), entries):
+                if entry.data is not None and entry.offset >= 0:
+                    entry.data = None
+                    self.history.update(index, entry)
 
-        logger.info("Saved history")
+            logger.debug("Saved history")
 
-    def set_autosave(self, autosave):
-        if bool(autosave):
-            self.save()
-        self.cfg.set_value('autosave', bool(autosave))
+    def sync(self):
+        """
+        Commit entries saved since the last checkpoint, if any
+        """
+        with self.lock:
+            ps_history = self.ps_history
+            # run periodically, the whole meta file is rewritten
+            if self.autosave and (ps_history.unsynced > 0 or
+                                  len(ps_history.dead_ranges) > 0):
+                ps_history.checkpoint()
+
+    def configure(self, values):
+        """
+        Apply several configurations at once. Nothing is changed if any
+        value is invalid. Entries are pruned and expired once for all,
+        and the history is saved once if autosave is turned on.
+        """
+        for key in ('max_entry', 'max_length', 'max_age'):
+            if key in values and values[key] <= 0:
+                return False
+
+        with self.lock:
+            autosave = bool(values.get('autosave', self.autosave))
+            enable = autosave and not self.autosave
+            if not autosave:
+                # before pruning, so that the file is left as is
+                self.autosave = False
+                # positions handed out from now on are not saved
+                self.ps_history.epoch = new_epoch()
+            self.max_entry = values.get('max_entry', self.max_entry)
+            self.max_length = values.get('max_length', self.max_length)
+            self.max_age = values.get('max_age', self.max_age)
+            for key, value in values.items():
+                self.cfg.set_value(key, value)
+
+            if 'max_entry' in values and self.size() > self.max_entry:
+                self.del_head(self.size() - self.max_entry)
+            if 'max_age' in values:
+                self.expire()
+            if enable:
+                # pruned in RAM only, all saved in one go
+                self.save()
+                self.autosave = True
         return True
 
+    def set_autosave(self, autosave):
+        return self.configure({'autosave': bool(autosave)})
+
     def set_max_entry(self, num):
-        if num <= 0:
-            return False
-        diff = self.size() - num
-        if diff > 0:
-            self.del_range(0, diff)
-        self.cfg.set_value('max_entry', num)
-        return True
+        return self.configure({'max_entry': num})
+
+    def set_max_age(self, num):
+        return self.configure({'max_age': num})
 
     def set_max_length(self, num):
-        if num <= 0:
-            return False
-        self.cfg.set_value('max_length', num)
-        return True
+        return self.configure({'max_length': num})
+
+RECORD_MAGIC = b'CLP2'
+# magic, length of data, time, checksum of the record
+RECORD_HEADER = struct.Struct('<4sQdI')
+
+# entries saved between checkpoints of meta data. A checkpoint rewrites
+# the whole meta file, its cost grows with the size of history.
+CHECKPOINT_ENTRIES = 64
+
+def record_header(data, time):
+    """
+    Return the header of a record. The checksum covers both the header,
+    computed with a zero checksum, and the data.
+    """
+    crc = zlib.crc32(RECORD_HEADER.pack(RECORD_MAGIC, len(data), time, 0))
+    crc = zlib.crc32(data, crc)
+    return RECORD_HEADER.pack(RECORD_MAGIC, len(data), time, crc)
 
 class PersistentHistory:
     """
     Manage clip history in file to make it persistent
+
+    The data file is binary, the text of each entry is saved as a record
+    made of a header and the UTF-8 encoded text. The offset and length
+    of an entry are those of the encoded text in bytes. Reads are served
+    as memoryview slices of a mmap of the data file.
+
+    Records are appended to the data file as entries are saved, while
+    the meta file is only committed at checkpoints, along with the size
+    of data it covers. After a crash, entries saved since the last
+    checkpoint are recovered by scanning the records after it, their
+    checksums tell where valid data ends.
     """
     data_dir = None
     data_file = None
     data_fd = None
+    data_map = None
     meta_file = None
     meta_man = None
+    lock = None
+    unsynced = 0
+    batch = 0 #depth of transactions, see begin()
+    batch_start = None #offset of the first record of the transaction
+    dead_ranges = None #data of deleted entries to deallocate
+    in_file_order = True #whether entries are in the order of their data
+    epoch = None #of the positions in the log, see ClipHistory.get_log()
+    next_seq = 0 #position in the log of the next entry added
 
     def __init__(self):
+        # data file is shared by the monitor, DBus and transport threads
+        self.lock = threading.Lock()
+        self.dead_ranges = []
         self.data_dir = get_user_data_dir()
         self.data_dir = os.path.join(self.data_dir, 'clipon')
-        self.data_file = os.path.join(self.data_dir, 'history.txt')
-        self.data_fd = helper.open_file(self.data_dir, self.data_file, 'r+')
-        if self.data_fd is None:
-            raise Exception("Failed to open data file")
-
+        self.data_file = os.path.join(self.data_dir, 'history.dat')
         self.meta_file = os.path.join(self.data_dir, 'clipon.xml')
         self.meta_fd = helper.open_file(self.data_dir, self.meta_file, 'r+')
         if self.meta_fd is None:
@@ -157,22 +996,286 @@ class PersistentHistory:
 
         self.meta_man = MetaManager(self.meta_file)
 
-    def save_entry(self, entry):
-        #seek to the end of file
-        entry.offset = self.data_fd.seek(0, 2)
-        entry.length = len(entry.text)
-        try:
-            self.data_fd.seek(entry.offset, 0)
-            self.data_fd.write(entry.text)
-            self.data_fd.flush()
-        except:
-            logging.error("Write error when saving entry\n")
-            return
+        # the meta file of the text file is kept until it's migrated
+        text_file = os.path.join(self.data_dir, 'history.txt')
+        text_meta_file = self.meta_file + '.txt'
+        if os.path.isfile(text_file) and (os.path.isfile(text_meta_file) or
+                                          not os.path.isfile(self.data_file)):
+            self.migrate(text_file, text_meta_file)
+        elif os.path.isfile(text_meta_file):
+            os.remove(text_meta_file)
+
+        self.data_fd = helper.open_file(self.data_dir, self.data_file, 'r+b')
+        if self.data_fd is None:
+            raise Exception("Failed to open data file")
+
+    def migrate(self, text_file, text_meta_file):
+        """
+        Convert the text data file of older versions, whose offsets are
+        positions of the text file and lengths are numbers of characters.
+        The meta file of the text file is copied first, and removed only
+        after the text file, so a migration interrupted by a crash is
+        done again from it on next start.
+        """
+        logger.info("Migrating %s to %s", text_file, self.data_file)
+        if not os.path.isfile(text_meta_file):
+            tmp_file = text_meta_file + '.tmp'
+            shutil.copyfile(self.meta_file, tmp_file)
+            with open(tmp_file, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_file, text_meta_file)
+
+        meta_man = MetaManager(text_meta_file)
+        tmp_file = self.data_file + '.tmp'
+        src = open(text_file, 'r', encoding='utf-8')
+        dst = open(tmp_file, 'wb')
+        for index in range(meta_man.size()):
+            attrs = meta_man.get_element('clip', index)
+            src.seek(int(attrs['offset']), 0)
+            data = src.read(int(attrs['length'])).encode('utf-8')
+            offset = dst.tell() + RECORD_HEADER.size
+            dst.write(record_header(data, float(attrs['time'])))
+            dst.write(data)
+            attrs['offset'] = str(offset)
+            attrs['length'] = str(len(data))
+        dst.flush()
+        os.fsync(dst.fileno())
+        dst.close()
+        src.close()
+
+        os.replace(tmp_file, self.data_file)
+        meta_man.file_name = self.meta_file
+        meta_man.save()
+        self.meta_man = meta_man
+        os.remove(text_file)
+        os.remove(text_meta_file)
+
+    def write_record(self, entry):
+        """
+        Append the data of an entry to the data file, setting its offset
+        and length. Return False on error.
+        """
+        data = entry.data
+        header = record_header(data, entry.time)
+        with self.lock:
+            try:
+                #seek to the end of file
+                offset = self.data_fd.seek(0, 2) + RECORD_HEADER.size
+                if self.batch > 0 and self.batch_start is None:
+                    self.batch_start = offset - RECORD_HEADER.size
+                self.data_fd.write(header)
+                self.data_fd.write(data)
+                if self.batch == 0:
+                    self.data_fd.flush()
+            except:
+                logger.error("Write error when saving entry")
+                return False
+
+        entry.offset = offset
+        entry.length = len(data)
+        return True
+
+    def save_entry(self, entry, index = None):
+        """
+        Append the data of an entry to the data file, and add it to the
+        meta data at the given index, by default at the end
+        """
+        if not self.write_record(entry):
+            return False
 
         #save entry to clipon meta file
-        attrs = {'time':entry.time, 'offset':entry.offset, 'length':entry.length}
+        self.add_meta(entry, index)
+        self.unsynced += 1
+        if self.unsynced >= CHECKPOINT_ENTRIES and self.batch == 0:
+            self.checkpoint()
+        return True
+
+    def replace_entry(self, index, entry):
+        """
+        Save an entry in place of the one at index. The record of the
+        old one is deallocated at next checkpoint, no other entry
+        refers to it.
+        """
+        attrs = self.meta_man.get_element('clip', index)
+        if attrs is None:
+            return False
+        old_offset = int(attrs['offset'])
+        old_length = int(attrs['length'])
+        if not self.write_record(entry):
+            return False
+
+        for key, value in (('time', entry.time), ('offset', entry.offset),
+                           ('length', entry.length), ('digest', entry.digest),
+                           ('simhash', entry.simhash), ('mask', entry.mask),
+                           ('pairs', entry.pairs), ('seq', entry.seq)):
+            self.meta_man.set_attribute(index, key, value)
+        self.meta_man.del_attribute(index, 'uses')
+        self.meta_man.del_attribute(index, 'pinned')
+        self.dead_ranges.append((old_offset - RECORD_HEADER.size,
+                                 old_offset + old_length))
+        self.unsynced += 1
+        if self.unsynced >= CHECKPOINT_ENTRIES and self.batch == 0:
+            self.checkpoint()
+        return True
+
+    def begin(self):
+        """
+        Start a transaction, records of the entries saved until commit()
+        are written without flushing each of them
+        """
+        self.batch += 1
+
+    def commit(self):
+        """
+        Make the records saved in the transaction durable with one sync
+        of the data file. The meta data is left to the next checkpoint,
+        rewriting it for each batch would cost as much as the whole
+        history, while records after the checkpoint are recovered anyway.
+        """
+        self.batch -= 1
+        if self.batch == 0 and self.unsynced > 0:
+            with self.lock:
+                self.data_fd.flush()
+                os.fsync(self.data_fd.fileno())
+        if self.batch == 0:
+            # the meta data has the entries of the transaction by now,
+            # the next checkpoint covers them
+            self.batch_start = None
+
+    def add_meta(self, entry, index = None):
+        attrs = {'time':entry.time, 'offset':entry.offset, 'length':entry.length,
+                 'digest':entry.digest, 'seq':entry.seq}
+        if entry.simhash != 0:
+            attrs['simhash'] = entry.simhash
+        if entry.mask != 0:
+            attrs['mask'] = entry.mask
+            attrs['pairs'] = entry.pairs
+        if entry.uses > 0:
+            attrs['uses'] = entry.uses
+        if entry.pinned:
+            attrs['pinned'] = 1
         elem = self.meta_man.new_element('clip', attrs)
-        self.meta_man.add_element(elem)
+        if index is None or index >= self.meta_man.size():
+            self.meta_man.add_element(elem)
+        else:
+            self.meta_man.insert_element(index, elem)
+            self.in_file_order = False
+
+    def set_uses(self, index, uses):
+        # committed along with the meta data at next checkpoint
+        self.meta_man.set_attribute(index, 'uses', uses)
+        self.unsynced += 1
+
+    def set_simhash(self, index, simhash):
+        self.meta_man.set_attribute(index, 'simhash', simhash)
+        self.unsynced += 1
+
+    def set_masks(self, index, mask, pairs):
+        self.meta_man.set_attribute(index, 'mask', mask)
+        self.meta_man.set_attribute(index, 'pairs', pairs)
+        self.unsynced += 1
+
+    def set_pinned(self, index, pinned):
+        if pinned:
+            self.meta_man.set_attribute(index, 'pinned', 1)
+        else:
+            self.meta_man.del_attribute(index, 'pinned')
+        self.unsynced += 1
+
+    def checkpoint(self):
+        """
+        Sync the data file, then commit the meta data along with the
+        size of data it covers. Records of a transaction in progress
+        might not be in the meta data yet, the checkpoint stops before
+        them so that they are recovered after a crash.
+        """
+        with self.lock:
+            self.data_fd.flush()
+            os.fsync(self.data_fd.fileno())
+            end = self.data_fd.seek(0, 2)
+            if self.batch_start is not None:
+                end = min(end, self.batch_start)
+        self.meta_man.set_checkpoint(end)
+        self.meta_man.set_log_state(self.epoch, self.next_seq)
+        self.meta_man.save()
+        self.unsynced = 0
+
+        # data of deleted head entries is no longer referenced on disk,
+        # if not supported, space is reclaimed on next full save. Runs
+        # of adjacent records are deallocated at once. Those after the
+        # checkpoint are kept until it covers them, as records there
+        # are scanned when recovering.
+        ranges = []
+        pending = []
+        for start, stop in sorted(self.dead_ranges):
+            if stop > end:
+                pending.append((start, stop))
+            elif len(ranges) > 0 and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([start, stop])
+        for start, stop in ranges:
+            helper.punch_hole(self.data_fd.fileno(), start, stop - start)
+        self.dead_ranges = pending
+
+    def save_all(self, entries, others = ()):
+        """
+        Make the given entries the whole content of the history file.
+        Entries whose data is not in RAM have their records in the data
+        file already and are kept as is, the others are appended in one
+        streamed write. Records of no entry, either of entries or others,
+        are deallocated. Return False on error.
+        """
+        with self.lock:
+            size = self.data_fd.seek(0, 2)
+        reused = [e for e in entries if e.data is None]
+        for entry in reused:
+            if entry.offset < RECORD_HEADER.size or entry.offset + entry.length > size:
+                logger.error("Entry out of data file at offset %d", entry.offset)
+                return False
+        if len(reused) == 0 and len(others) == 0:
+            # nothing to keep, start over with an empty data file
+            self.reset_data()
+            size = 0
+
+        with self.lock:
+            try:
+                pos = self.data_fd.seek(0, 2)
+                for entry in entries:
+                    data = entry.data
+                    if data is None:
+                        continue
+                    self.data_fd.write(record_header(data, entry.time))
+                    self.data_fd.write(data)
+                    entry.offset = pos + RECORD_HEADER.size
+                    entry.length = len(data)
+                    pos = entry.offset + entry.length
+            except OSError:
+                logger.error("Write error when saving history")
+                return False
+
+        self.meta_man.clear()
+        for entry in entries:
+            self.add_meta(entry)
+
+        # data before the old end of file not referenced any more is dead
+        ranges = sorted((e.offset - RECORD_HEADER.size, e.offset + e.length)
+                        for e in reused + list(others))
+        dead_ranges = []
+        dead_end = 0
+        for begin, end in ranges:
+            if begin > dead_end:
+                dead_ranges.append((dead_end, begin))
+            dead_end = max(dead_end, end)
+        if dead_end < size:
+            dead_ranges.append((dead_end, size))
+        self.dead_ranges = dead_ranges
+
+        offsets = [e.offset for e in entries]
+        self.in_file_order = all(offsets[i - 1] < offsets[i]
+                                 for i in range(1, len(offsets)))
+        self.checkpoint()
+        return True
 
     def load_entry(self, index):
         attrs = self.meta_man.get_element('clip', index)
@@ -184,42 +1287,254 @@ class PersistentHistory:
             length = attrs['length']
             time = attrs['time']
         except KeyError:
-            logging.error("Element attribute error")
+            logger.error("Element attribute error")
             return None
 
-        offset = int(offset)
-        length = int(length)
-        time = float(time)
+        # digest, fingerprint and masks are missing in files of older
+        # versions
+        digest = int(attrs.get('digest', 0))
+        fingerprint = int(attrs.get('simhash', 0))
+        uses = int(attrs.get('uses', 0))
+        mask = int(attrs.get('mask', 0))
+        pairs = int(attrs.get('pairs', 0))
+        seq = int(attrs.get('seq', -1))
 
-        text = None
-        try:
-            self.data_fd.seek(offset, 0)
-            text = self.data_fd.read(length)
-        except:
-            logging.error("Read error at offset %d length %d\n" % (int(offset), int(length)))
-            return None
-
-        entry = ClipEntry(text, float(time), int(offset), int(length))
+        # data is not loaded until requested, see read_data()
+        entry = ClipEntry(None, float(time), int(offset), int(length), digest,
+                          fingerprint, uses, mask, pairs, seq)
+        entry.pinned = 'pinned' in attrs
 
         return entry
 
-    def load_all(self, entry_list):
+    def read_data(self, entry, start = 0, end = INT_MAX):
+        """
+        Return a memoryview of the bytes [start, end) of the data of an
+        entry. Nothing is copied from the mapped file.
+        """
+        end = min(end, entry.length)
+        if start >= end:
+            return memoryview(b'')
+
+        begin = entry.offset + start
+        end = entry.offset + end
+        with self.lock:
+            if self.data_map is None or end > len(self.data_map):
+                # the file has grown since mapped. The old map is closed
+                # once all the views of it are released.
+                self.data_fd.flush()
+                size = os.fstat(self.data_fd.fileno()).st_size
+                if end > size:
+                    logger.error("Read error at offset %d length %d", begin, end - begin)
+                    return None
+                self.data_map = mmap.mmap(self.data_fd.fileno(), size,
+                                          access=mmap.ACCESS_READ)
+            data_map = self.data_map
+
+        return memoryview(data_map)[begin:end]
+
+    def read_text(self, entry, start = 0, end = INT_MAX):
+        """
+        Read the slice [start, end) of the text of an entry from file,
+        start and end are in characters. The cost is proportional to end
+        rather than the entry length.
+        """
+        if end >= entry.length:
+            data = self.read_data(entry)
+            errors = 'strict'
+        else:
+            # a character is encoded in at most 4 bytes, the last one
+            # might be cut
+            data = self.read_data(entry, 0, end * 4)
+            errors = 'ignore'
+
+        if data is None:
+            return None
+        return str(data, 'utf-8', errors)[start:end]
+
+    def load_all(self, entry_list, pinned):
+        """
+        Load entries into entry_list, and add (time, digest) of pinned
+        entries to the pinned set
+        """
         fsize = 0
+        unlogged = [] # saved by older versions, without a position
         num = self.meta_man.size()
         for i in range(num):
             entry = self.load_entry(i)
             if entry is not None:
+                if entry.seq < 0:
+                    unlogged.append((i, len(entry_list)))
+                if entry.pinned:
+                    if entry.digest == 0:
+                        # missing in files of older versions
+                        data = self.read_data(entry)
+                        if data is not None:
+                            entry.digest = data_digest(data)
+                    pinned.add((entry.time, entry.digest))
                 entry_list.append(entry)
                 if entry.offset + entry.length > fsize:
                     fsize = entry.offset + entry.length
+                else:
+                    self.in_file_order = False
+
+        checkpoint = self.meta_man.get_checkpoint()
+        if checkpoint is None:
+            # files of older versions, the meta data covers all entries
+            checkpoint = fsize
+
+        epoch, next_seq = self.meta_man.get_log_state()
+        seqs = entry_list.seqs
+        self.next_seq = max(next_seq, max(seqs) + 1 if len(seqs) > 0 else 0)
+        for i, index in unlogged:
+            seqs[index] = self.next_seq
+            self.meta_man.set_attribute(i, 'seq', self.next_seq)
+            self.next_seq += 1
+        if unlogged:
+            epoch = None
+
+        end, num = self.recover(entry_list, checkpoint)
+        if num > 0:
+            self.sort_recovered(entry_list, num)
+
+        # positions handed out to entries saved after the checkpoint
+        # are lost, followers start over in a new epoch
+        self.epoch = epoch if epoch is not None and num == 0 else new_epoch()
+
+        #clear untracked data, like a record partially written
+        if end < self.data_fd.seek(0, 2):
+            self.data_fd.truncate(end)
+            self.data_fd.flush()
+
+        if num > 0 or end != self.meta_man.get_checkpoint() or self.epoch != epoch:
+            self.checkpoint()
+
+    def recover(self, entry_list, offset):
+        """
+        Load entries from records after the given offset of the data
+        file, until the end or an invalid record. Records of entries in
+        the meta data already, saved during a transaction, are skipped.
+        Return the end of the valid records and the number of entries
+        recovered.
+        """
+        size = self.data_fd.seek(0, 2)
+        pos = min(offset, size)
+        num = 0
+        known = None
+        loaded = len(entry_list)
+        while pos + RECORD_HEADER.size <= size:
+            self.data_fd.seek(pos, 0)
+            header = self.data_fd.read(RECORD_HEADER.size)
+            magic, length, time, crc = RECORD_HEADER.unpack(header)
+            begin = pos + RECORD_HEADER.size
+            if magic != RECORD_MAGIC or begin + length > size:
+                break
+            data = self.data_fd.read(length)
+            if record_header(data, time) != header:
+                break
+
+            if known is None:
+                known = set(o for o in entry_list.offsets if o >= offset)
+                last = max(entry_list.offsets) if len(entry_list) > 0 else -1
+            pos = begin + length
+            if begin in known:
+                continue
+            digest = data_digest(data)
+            if self.find_loaded(entry_list, time, digest, loaded):
+                continue #deleted as a duplicate when saved
+            if begin < last:
+                self.in_file_order = False
+            entry = ClipEntry(None, time, begin, length, digest, seq=self.next_seq)
+            self.next_seq += 1
+            entry_list.append(entry)
+            self.add_meta(entry)
+            num += 1
+
+        if num > 0:
+            logger.info("Recovered %d entries after checkpoint", num)
+        return pos, num
+
+    def find_loaded(self, entry_list, time, digest, end):
+        # entries loaded from the meta data are in time order
+        times = entry_list.times
+        index = bisect.bisect_left(times, time, 0, end)
+        while index < end and times[index] == time:
+            if entry_list.digests[index] == digest:
+                return True
+            index += 1
+        return False
 
-        #clear untracked data
-        self.data_fd.truncate(fsize)
-        self.data_fd.flush()
+    def sort_recovered(self, entry_list, num):
+        """
+        Entries replicated from other daemons are inserted in time order
+        but recovered in file order, restore the time order if needed
+        """
+        times = entry_list.times
+        first = max(len(times) - num, 1)
+        if all(times[i - 1] <= times[i] for i in range(first, len(times))):
+            return
+
+        order = sorted(range(len(times)), key=times.__getitem__)
+        entry_list.reorder(order)
+        self.meta_man.reorder(order)
+        self.in_file_order = False
 
     def delete_entry(self, entry, index):
         pass
 
+    def delete_head(self, num, keep = ()):
+        """
+        Delete the oldest num entries, except those at indexes in keep.
+        Their data is deallocated from the data file in place at next
+        checkpoint, so offsets of the others don't change.
+        """
+        if not self.in_file_order:
+            # records of the deleted entries are scattered, each is dead
+            kept = set(keep)
+            for index in range(min(num, self.meta_man.size())):
+                if index not in kept:
+                    attrs = self.meta_man.get_element('clip', index)
+                    offset = int(attrs['offset'])
+                    self.dead_ranges.append((offset - RECORD_HEADER.size,
+                                             offset + int(attrs['length'])))
+
+        self.meta_man.del_head(num, keep)
+        if self.meta_man.size() == 0:
+            self.reset_data()
+            self.checkpoint()
+            return
+
+        # if entries are saved in file order, data before the first
+        # entry kept, between the kept ones and before the first one
+        # after them is dead
+        if self.in_file_order:
+            dead_end = 0
+            for index in range(len(keep) + 1):
+                attrs = self.meta_man.get_element('clip', index)
+                if attrs is None:
+                    break
+                offset = int(attrs['offset'])
+                if offset - RECORD_HEADER.size > dead_end:
+                    self.dead_ranges.append((dead_end, offset - RECORD_HEADER.size))
+                dead_end = offset + int(attrs['length'])
+        self.unsynced += num
+        if self.unsynced >= CHECKPOINT_ENTRIES and self.batch == 0:
+            self.checkpoint()
+
+    def reset_data(self):
+        """
+        Replace the data file with an empty one. It's not truncated, as
+        views of the mapped file might still be in use by other threads.
+        """
+        tmp_file = self.data_file + '.tmp'
+        open(tmp_file, 'wb').close()
+        with self.lock:
+            os.rename(tmp_file, self.data_file)
+            self.data_fd.close()
+            self.data_fd = open(self.data_file, 'r+b')
+            self.data_map = None
+            self.dead_ranges = []
+            self.in_file_order = True
+
     def delete_all(self):
 
         #clear meta file
@@ -227,9 +1542,8 @@ class PersistentHistory:
         self.meta_man = MetaManager(self.meta_file)
 
         #clear data file
-        self.data_fd.truncate(0)
-        self.data_fd.seek(0, 0)
-        self.data_fd.flush()
+        self.reset_data()
+        self.checkpoint()
 
     def info(self):
         info = {}
@@ -237,15 +1551,201 @@ class PersistentHistory:
         info['meta file'] = self.meta_file
         return info
 
+def new_epoch():
+    return int.from_bytes(os.urandom(8), 'big') >> 1
+
+def data_digest(data):
+    """
+    Return a 64 bits digest of the data as a signed integer, for telling
+    identical clips apart without comparing their texts
+    """
+    h = hashlib.blake2b(data, digest_size=8)
+    return int.from_bytes(h.digest(), 'little', signed=True)
+
+class ClipIndex:
+    """
+    Compact in-memory index of clip entries
+
+    Instead of an object per entry, attributes of the entries are kept
+    in parallel typed arrays, so each entry costs a few dozens of bytes.
+    ClipEntry objects are made on demand when indexing. Only entries not
+    saved to file have their data kept in RAM.
+    """
+    times = None
+    offsets = None
+    lengths = None
+    digests = None
+    simhashes = None
+    uses = None
+    masks = None
+    pairs = None
+    seqs = None
+    data = None
+
+    def __init__(self):
+        self.times = array('d')
+        self.offsets = array('q')
+        self.lengths = array('q')
+        self.digests = array('q')
+        self.simhashes = array('q')
+        self.uses = array('i')
+        self.masks = array('q')
+        self.pairs = array('q')
+        self.seqs = array('q')
+        self.data = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        return ClipEntry(self.data[index], self.times[index],
+                         self.offsets[index], self.lengths[index],
+                         self.digests[index], self.simhashes[index],
+                         self.uses[index], self.masks[index], self.pairs[index],
+                         self.seqs[index])
+
+    def insert(self, index, entry):
+        self.times.insert(index, entry.time)
+        self.offsets.insert(index, entry.offset)
+        self.lengths.insert(index, entry.length)
+        self.digests.insert(index, entry.digest)
+        self.simhashes.insert(index, entry.simhash)
+        self.uses.insert(index, entry.uses)
+        self.masks.insert(index, entry.mask)
+        self.pairs.insert(index, entry.pairs)
+        self.seqs.insert(index, entry.seq)
+        self.data.insert(index, entry.data)
+
+    def append(self, entry):
+        self.times.append(entry.time)
+        self.offsets.append(entry.offset)
+        self.lengths.append(entry.length)
+        self.digests.append(entry.digest)
+        self.simhashes.append(entry.simhash)
+        self.uses.append(entry.uses)
+        self.masks.append(entry.mask)
+        self.pairs.append(entry.pairs)
+        self.seqs.append(entry.seq)
+        self.data.append(entry.data)
+
+    def update(self, index, entry):
+        self.times[index] = entry.time
+        self.offsets[index] = entry.offset
+        self.lengths[index] = entry.length
+        self.digests[index] = entry.digest
+        self.simhashes[index] = entry.simhash
+        self.uses[index] = entry.uses
+        self.masks[index] = entry.mask
+        self.pairs[index] = entry.pairs
+        self.seqs[index] = entry.seq
+        self.data[index] = entry.data
+
+    def reorder(self, order):
+        """
+        Rearrange entries so that the i-th one is the order[i]-th before
+        """
+        for name in ('times', 'offsets', 'lengths', 'digests', 'simhashes',
+                     'uses', 'masks', 'pairs', 'seqs'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[i] for i in order]))
+        self.data = [self.data[i] for i in order]
+
+    def delete(self, start, end):
+        del self.times[start:end]
+        del self.offsets[start:end]
+        del self.lengths[start:end]
+        del self.digests[start:end]
+        del self.simhashes[start:end]
+        del self.uses[start:end]
+        del self.masks[start:end]
+        del self.pairs[start:end]
+        del self.seqs[start:end]
+        del self.data[start:end]
+
+    def clear(self):
+        self.delete(0, len(self))
+
+class UsageIndex:
+    """
+    Number of times clips were copied and used, by their digest
+
+    It's derived from the digest and uses columns of history: digests
+    are kept sorted, so that the copies of a clip are counted by
+    bisecting them, and uses are only kept for the clips used.
+    """
+    digests = None
+    uses = None
+    max_usage = 0 # upper bound of the usage of any clip
+
+    def __init__(self, digests, uses):
+        self.digests = array('q', sorted(digests))
+        self.uses = {}
+        for digest, num in zip(digests, uses):
+            if num > 0:
+                self.uses[digest] = self.uses.get(digest, 0) + num
+
+        sorted_digests = self.digests
+        start = 0
+        for i in range(1, len(sorted_digests) + 1):
+            if i == len(sorted_digests) or sorted_digests[i] != sorted_digests[start]:
+                usage = i - start + self.uses.get(sorted_digests[start], 0)
+                self.max_usage = max(self.max_usage, usage)
+                start = i
+
+    def __getitem__(self, digest):
+        copies = bisect.bisect_right(self.digests, digest) - \
+            bisect.bisect_left(self.digests, digest)
+        return copies + self.uses.get(digest, 0)
+
+    def add(self, digest, uses = 0):
+        bisect.insort(self.digests, digest)
+        if uses > 0:
+            self.uses[digest] = self.uses.get(digest, 0) + uses
+        self.max_usage = max(self.max_usage, self[digest])
+
+    def use(self, digest):
+        self.uses[digest] = self.uses.get(digest, 0) + 1
+        self.max_usage = max(self.max_usage, self[digest])
+
+    def remove(self, digest, uses = 0):
+        # max_usage is left as is, it's only an upper bound
+        index = bisect.bisect_left(self.digests, digest)
+        if index < len(self.digests) and self.digests[index] == digest:
+            del self.digests[index]
+        if uses > 0:
+            left = self.uses.get(digest, 0) - uses
+            if left > 0:
+                self.uses[digest] = left
+            else:
+                self.uses.pop(digest, None)
+
 class ClipEntry:
     """
     Clip entry infomation
     """
-    def __init__(self, text = None, time = None, offset = -1, length = 0):
-        self.text = text
+    __slots__ = ('data', 'time', 'offset', 'length', 'digest', 'simhash',
+                 'uses', 'mask', 'pairs', 'seq', 'pinned')
+
+    def __init__(self, data = None, time = None, offset = -1, length = 0,
+                 digest = 0, simhash = 0, uses = 0, mask = 0, pairs = 0,
+                 seq = 0):
+        self.data = data # UTF-8 encoded text, None if only in file
         self.time = time if time is not None else sys_time()
         self.offset = offset
         self.length = length
+        self.digest = digest # 0 if unknown, see data_digest()
+        self.simhash = simhash # 0 if unknown, see similar.simhash()
+        self.uses = uses # times used after picked
+        self.mask = mask # 0 if unknown, see fuzzy.char_mask()
+        self.pairs = pairs # see fuzzy.pair_mask()
+        self.seq = seq # position in the log, see ClipHistory.get_log()
+        self.pinned = False # only set when saving to file
+
+    @property
+    def text(self):
+        if self.data is None:
+            return None
+        return str(self.data, 'utf-8')
 
     def info(self):
         d = {'time':self.time, 'text':self.text}
@@ -264,7 +1764,7 @@ class MetaManager:
         try:
             self.tree = self.parse(file_name)
         except ET.ParseError:
-            logger.error(str(ET.ParseError))
+            logger.error("Failed to parse %s", file_name)
             if os.path.getsize(file_name) > 0:
                 raise Exception("Error parsing file %s" % file_name)
             #create a new tree if the file is empty
@@ -295,11 +1795,43 @@ class MetaManager:
         return ET.parse(file_name)
 
     def save(self):
+        """
+        Write the meta file atomically, the old file is replaced only
+        once the new one is completely written
+        """
         if self.root is not None:
             pretty_xml = format_pretty(self.root)
-            f = open(self.file_name, 'w')
+            tmp_file = self.file_name + '.tmp'
+            f = open(tmp_file, 'w')
             f.write(pretty_xml)
+            f.flush()
+            os.fsync(f.fileno())
             f.close()
+            os.replace(tmp_file, self.file_name)
+
+    def get_checkpoint(self):
+        """
+        Return the size of data file covered by the meta data, or None
+        if it's not recorded
+        """
+        checkpoint = self.root.get('checkpoint')
+        return int(checkpoint) if checkpoint is not None else None
+
+    def set_checkpoint(self, offset):
+        self.root.set('checkpoint', str(offset))
+
+    def get_log_state(self):
+        """
+        Return the epoch of the positions in the log, None if it's not
+        recorded, and the position of the next entry
+        """
+        epoch = self.root.get('epoch')
+        return (int(epoch) if epoch is not None else None,
+                int(self.root.get('next_seq', 0)))
+
+    def set_log_state(self, epoch, next_seq):
+        self.root.set('epoch', str(epoch))
+        self.root.set('next_seq', str(next_seq))
 
     def create_root(self, name, version):
         root = ET.Element(name)
@@ -307,16 +1839,19 @@ class MetaManager:
         return root
 
     def new_element(self, name, attrs):
-        elem = ET.Element(name)
-        for key, value in attrs.items():
-            elem.set(key, str(value)) #must convert value to string
-
-        return elem
+        #must convert values to string
+        return ET.Element(name, {k: str(v) for k, v in attrs.items()})
 
     def add_element(self, elem):
         parent = self.root
         parent.append(elem)
-        self.save()
+
+    def insert_element(self, index, elem):
+        self.root.insert(index, elem)
+
+    def reorder(self, order):
+        elems = list(self.root)
+        self.root[:] = [elems[i] for i in order]
 
     def get_element(self, name, index):
         root = self.root
@@ -325,12 +1860,27 @@ class MetaManager:
         elem = root[index]
         return elem.attrib
 
+    def set_attribute(self, index, key, value):
+        if index < self.size():
+            self.root[index].set(key, str(value))
+
+    def del_attribute(self, index, key):
+        if index < self.size():
+            self.root[index].attrib.pop(key, None)
+
     def del_element(self, elem):
         root = self.root
         root.remove(elem)
-        self.save()
+
+    def del_head(self, num, keep = ()):
+        kept = [self.root[index] for index in keep]
+        del self.root[0:num]
+        self.root[0:0] = kept
+
+    def clear(self):
+        # not saved until the next checkpoint
+        self.create_tree()
 
     def del_all(self):
-        self.root = self.create_root(self.ROOT_TAG, CLIPON_VERSION)
-        self.tree = ET.ElementTree(self.root)
+        self.clear()
         self.save()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import os
+import json
+import socket
+import threading
+from transport import TransportClient, TransportError
+from history import ClipEntry
+from helper import logger
+
+"""
+Replication of the history from another daemon on the same host
+
+A follower connects to the transport socket of the leader and asks for
+the entries since its position, that is the position after the latest
+entry it has merged in the log of the leader. The log holds entries in
+the order they were added, wherever they are in time order, so entries
+inserted with older times are replicated too. The leader streams the
+logged entries and then new ones as they are added, so after the first
+run only the delta is sent. The leader saves the position of each entry
+in the log with its meta data, so positions hold across restarts of the
+leader. The epoch changes when positions might have been lost, after
+the leader recovered from a crash or while it's not saving the history,
+and a position of another epoch starts over from the whole history.
+Entries are identified by their time and digest, merging one that is
+already in the history does nothing, so entries sent twice are
+harmless.
+
+The position is persisted only after the merged entries are committed
+to the history file, so that a crash of the follower never skips
+entries of the leader.
+"""
+
+RETRY_MIN = 1 #seconds
+RETRY_MAX = 60
+
+class Replicator(threading.Thread):
+    """
+    Follow the history of the daemon listening on the given socket
+    """
+    history = None
+    leader = None
+    position = (0, 0) # (epoch, seq) of the log of the leader
+    state_file = None
+
+    def __init__(self, history, leader, state_file):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.history = history
+        self.leader = leader
+        self.state_file = state_file
+        self.client = None
+        self.connected = False
+        self.merged = 0
+        self.stopped = threading.Event()
+        self.load_position()
+
+    def load_position(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        # the position is meaningless for a different leader
+        if state.get('leader') == self.leader and 'epoch' in state:
+            self.position = (state['epoch'], state['position'])
+
+    def save_position(self, position):
+        """
+        Persist the position, call it only after the entries merged up
+        to the position are committed to file
+        """
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'leader': self.leader, 'epoch': position[0],
+                       'position': position[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.state_file)
+
+    def run(self):
+        retry = RETRY_MIN
+        while not self.stopped.is_set():
+            try:
+                self.client = TransportClient(self.leader)
+            except OSError as e:
+                logger.warning("Failed to connect to %s: %s", self.leader, e)
+                self.stopped.wait(retry)
+                retry = min(retry * 2, RETRY_MAX)
+                continue
+
+            logger.info("Following %s from %d", self.leader, self.position[1])
+            self.connected = True
+            retry = RETRY_MIN
+            try:
+                self.follow()
+            except (TransportError, OSError) as e:
+                if not self.stopped.is_set():
+                    logger.warning("Lost connection to %s: %s", self.leader, e)
+            finally:
+                self.connected = False
+                self.client.close()
+            self.stopped.wait(retry)
+
+    def follow(self):
+        for epoch, seq, t, digest, data in self.client.follow(*self.position):
+            if self.stopped.is_set():
+                return
+            data = bytes(data)
+            entry = ClipEntry(data, t, length=len(data), digest=digest)
+            if self.history.merge(entry):
+                self.merged += 1
+            self.position = (epoch, seq + 1)
+
+    def stop(self):
+        self.stopped.set()
+        client = self.client
+        if client is not None:
+            # wake up the thread blocked on receiving
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.join(1)
+
+    def info(self):
+        return {
+            'Leader': self.leader,
+            'Connected': self.connected,
+            'Position': self.position[1],
+            'Merged entries': self.merged,
+        }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import re
+import bisect
+import hashlib
+from array import array
+
+"""
+Near-duplicate detection of clips
+
+Each clip gets a 64-bit SimHash fingerprint of the character shingles
+of its normalized text. Case, runs of digits (timestamps, counters) and
+runs of whitespace are folded by the normalization, so clips differing
+only by those have the same fingerprint, while clips differing by a few
+characters have fingerprints differing by a few bits.
+
+Fingerprints are indexed by bands: the 64 bits are cut into 4 bands of
+16 bits and each band is a table of rows sorted by their key in the
+band. Two fingerprints within 3 bits of each other have at least one
+band in common, so looking up the bands of a fingerprint finds all of
+its near-duplicates, by comparing only a few candidates instead of all
+the fingerprints.
+"""
+
+SHINGLE = 4 #characters per shingle
+MAX_CHARS = 4096 #only the beginning of long clips is fingerprinted
+BANDS = 4
+BAND_BITS = 64 // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+MAX_DISTANCE = BANDS - 1 #max different bits of near-duplicates
+MASK64 = (1 << 64) - 1
+
+DIGITS = re.compile(r'\d+')
+SPACES = re.compile(r'\s+')
+
+# each bit of a byte spread to a lane of 16 bits, so that the bits of
+# all the shingle hashes are counted with a few additions per shingle
+LANE_BITS = 16
+BIT_LANES = [sum(((b >> i) & 1) << (i * LANE_BITS) for i in range(8))
+             for b in range(256)]
+
+def normalize(text):
+    text = DIGITS.sub('0', text.lower())
+    return SPACES.sub(' ', text).strip()
+
+def simhash(text):
+    """
+    Return the fingerprint of a text as a signed 64-bit integer
+    """
+    text = normalize(text[:MAX_CHARS])
+    num = max(len(text) - SHINGLE + 1, 1)
+    shingles = set(text[i:i + SHINGLE] for i in range(num))
+
+    lanes = [0] * 8 # bit i of byte j is counted in lane i of lanes[j]
+    for shingle in shingles:
+        h = hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest()
+        for j in range(8):
+            lanes[j] += BIT_LANES[h[j]]
+
+    fingerprint = 0
+    half = len(shingles) // 2
+    for j in range(8):
+        for i in range(8):
+            if (lanes[j] >> (i * LANE_BITS)) & 0xffff > half:
+                fingerprint |= 1 << (j * 8 + i)
+
+    if fingerprint >= 1 << 63:
+        fingerprint -= 1 << 64
+    return fingerprint
+
+def distance(a, b):
+    return bin((a ^ b) & MASK64).count('1')
+
+def band_keys(fingerprint):
+    return [(fingerprint >> (i * BAND_BITS)) & BAND_MASK for i in range(BANDS)]
+
+ROW_BITS = 32
+ROW_MASK = (1 << ROW_BITS) - 1
+PENDING_MAX = 1024 #rows added before they're sorted into the tables
+
+def pack_rows(band, rows, fingerprints):
+    shift = band * BAND_BITS
+    return [(((fp >> shift) & BAND_MASK) << ROW_BITS) | row
+            for row, fp in zip(rows, fingerprints)]
+
+class SimilarIndex:
+    """
+    Banded LSH index of the fingerprints of history entries
+
+    Each band is a sorted array of the key in the band and the row of
+    entries packed in 64 bits, so an entry costs a few dozens of bytes.
+    Rows added since are scanned until there are PENDING_MAX of them.
+
+    Rows are counted from the oldest entry when the index was built, so
+    deleting the oldest entries only moves the base of rows, and the
+    rows deleted are skipped. Fingerprints are compared as read from
+    history, a row whose fingerprint changed is added again.
+    """
+    tables = None
+    pending = None
+    pending_fingerprints = None
+    base = 0
+    count = 0
+
+    def __init__(self, fingerprints):
+        rows = range(len(fingerprints))
+        self.tables = [array('q', sorted(pack_rows(i, rows, fingerprints)))
+                       for i in range(BANDS)]
+        self.pending = array('q')
+        self.pending_fingerprints = array('q')
+        self.base = 0
+        self.count = len(fingerprints)
+
+    def add(self, index, fingerprint):
+        self.pending.append(index + self.base)
+        self.pending_fingerprints.append(fingerprint)
+        self.count += 1
+        if len(self.pending) < PENDING_MAX:
+            return
+        for i, table in enumerate(self.tables):
+            # sorting two sorted runs is linear
+            packed = table.tolist()
+            packed.extend(pack_rows(i, self.pending, self.pending_fingerprints))
+            packed.sort()
+            self.tables[i] = array('q', packed)
+        self.pending = array('q')
+        self.pending_fingerprints = array('q')
+
+    def del_head(self, num):
+        self.base += num
+
+    def near(self, fingerprint, fingerprints):
+        """
+        Return the set of indexes of entries within MAX_DISTANCE bits of
+        the given fingerprint, fingerprints being those of history
+        """
+        size = len(fingerprints)
+        base = self.base
+        rows = []
+        for table, key in zip(self.tables, band_keys(fingerprint)):
+            lo = bisect.bisect_left(table, key << ROW_BITS)
+            hi = bisect.bisect_left(table, (key + 1) << ROW_BITS, lo)
+            rows.extend(table[i] & ROW_MASK for i in range(lo, hi))
+        rows.extend(self.pending)
+
+        found = set()
+        for row in rows:
+            index = row - base
+            if 0 <= index < size and index not in found and \
+                    distance(fingerprint, fingerprints[index]) <= MAX_DISTANCE:
+                found.add(index)
+        return found
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import heapq
+from array import array
+from collections import Counter
+from datetime import datetime
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Analytics of the clip history
+
+Aggregates are computed in bulk over the columns of the history index
+(time, length and digest), texts are never loaded except for previews
+of the top repeated clips. NumPy is used when available, otherwise it
+falls back to pure Python.
+"""
+
+HOURS = 24
+DAY = 86400
+
+def copy_column(column):
+    # a plain memory copy, not exporting the buffer of the column which
+    # would make appending to it fail meanwhile
+    copy = array(column.typecode)
+    copy.frombytes(column.tobytes())
+    return copy
+
+def snapshot(history):
+    """
+    Copy the columns needed, the arrays are still changed by the
+    clipboard monitor while computing. They're copied under the lock
+    of history, so that their rows match.
+    """
+    with history.lock:
+        index = history.history
+        return (copy_column(index.times), copy_column(index.lengths),
+                copy_column(index.digests))
+
+def utc_offset():
+    # hours and days are counted in local time with the current offset
+    return datetime.now().astimezone().utcoffset().total_seconds()
+
+def compute_numpy(times, lengths, digests, top):
+    times = np.frombuffer(times, dtype=np.float64)
+    lengths = np.frombuffer(lengths, dtype=np.int64)
+    digests = np.frombuffer(digests, dtype=np.int64)
+    local = times + utc_offset()
+
+    hours = (local // 3600).astype(np.int64) % HOURS
+    per_hour = np.bincount(hours, minlength=HOURS)
+
+    # bucket i holds lengths in [2^i, 2^(i+1))
+    buckets = np.log2(np.maximum(lengths, 1)).astype(np.int64)
+    sizes = np.bincount(buckets)
+
+    # index of the latest entry of each digest, by looking in reverse
+    rev = digests[::-1]
+    uniq, first, counts = np.unique(rev, return_index=True, return_counts=True)
+    latest = len(digests) - 1 - first
+    # most repeated first, then the most recent
+    order = np.lexsort((-latest, -counts))[:top]
+    repeated = [(int(latest[i]), int(counts[i]))
+                for i in order if counts[i] > 1]
+
+    days, inverse = np.unique(local // DAY, return_inverse=True)
+    growth = np.cumsum(np.bincount(inverse, weights=lengths))
+
+    return {
+        'per_hour': per_hour.tolist(),
+        'sizes': sizes.tolist(),
+        'repeated': repeated,
+        'growth': [(int(d) * DAY, int(g)) for d, g in zip(days, growth)],
+        'total_length': int(lengths.sum()),
+    }
+
+def compute_python(times, lengths, digests, top):
+    offset = utc_offset()
+
+    per_hour = [0] * HOURS
+    day_length = {}
+    for t, length in zip(times, lengths):
+        local = t + offset
+        per_hour[int(local // 3600) % HOURS] += 1
+        day = int(local // DAY)
+        day_length[day] = day_length.get(day, 0) + length
+
+    sizes = []
+    for length in lengths:
+        bucket = max(length, 1).bit_length() - 1
+        if bucket >= len(sizes):
+            sizes.extend([0] * (bucket + 1 - len(sizes)))
+        sizes[bucket] += 1
+
+    counts = Counter(digests)
+    latest = {}
+    for i, digest in enumerate(digests):
+        latest[digest] = i
+    # most repeated first, then the most recent
+    most = heapq.nsmallest(top, counts.items(),
+                           key=lambda item: (-item[1], -latest[item[0]]))
+    repeated = [(latest[d], c) for d, c in most if c > 1]
+
+    growth = []
+    total = 0
+    for day in sorted(day_length):
+        total += day_length[day]
+        growth.append((day * DAY, total))
+
+    return {
+        'per_hour': per_hour,
+        'sizes': sizes,
+        'repeated': repeated,
+        'growth': growth,
+        'total_length': total,
+    }
+
+def history_stats(history, top = 10):
+    """
+    Return a dict of aggregates of the history:
+      per_hour      number of clips copied in each hour of the day
+      sizes         number of clips whose length in bytes is in
+                    [2^i, 2^(i+1))
+      repeated      (index of latest copy, count) of the most repeated
+                    clips
+      growth        (day, total length of clips up to the day)
+      total_length  total length of clips in bytes
+    """
+    history.fill_digests()
+    times, lengths, digests = snapshot(history)
+    if len(times) == 0:
+        return {'size': 0, 'per_hour': [0] * HOURS, 'sizes': [],
+                'repeated': [], 'growth': [], 'total_length': 0}
+
+    if np is not None:
+        stats = compute_numpy(times, lengths, digests, top)
+    else:
+        stats = compute_python(times, lengths, digests, top)
+    stats['size'] = len(times)
+    return stats
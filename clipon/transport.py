@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import os
+import struct
+import socket
+import threading
+import socketserver
+from helper import logger, INT_MAX, get_runtime_dir
+
+"""
+Unix domain socket transport for bulk data
+
+DBus is used for controlling the daemon, while large clips and bulk
+listing go through a local stream socket so that the payload doesn't
+pass through the bus daemon nor get encoded as JSON strings.
+
+Each request is a frame made of a header (op, payload length) and a
+payload of packed arguments. Each reply is a frame made of a header
+(status, payload length) and the raw payload. Operations replying a
+sequence of entries terminate it with an empty frame of status END.
+"""
+
+REQ_HEADER = struct.Struct('!BI')
+REP_HEADER = struct.Struct('!BQ')
+
+# requests
+OP_GET = 1      # (index, start, end) -> text slice of an entry, start
+                #   and end are in characters
+OP_BLOB = 2     # (index,) -> whole text of an entry
+OP_EXPORT = 3   # (start, end, limit) -> sequence of entries in range,
+                #   the text of each cut after limit characters
+OP_FOLLOW = 4   # (epoch, seq) -> endless sequence of entries logged
+                #   from the position seq on, as they are added
+
+OP_ARGS = {
+    OP_GET: struct.Struct('!iqq'),
+    OP_BLOB: struct.Struct('!i'),
+    OP_EXPORT: struct.Struct('!iiq'),
+    OP_FOLLOW: struct.Struct('!qq'),
+}
+
+# reply status
+ST_OK = 0
+ST_ERROR = 1
+ST_END = 2
+
+# header of each entry replied by OP_EXPORT (index, time, length),
+# followed by the text. The length is of the whole text in bytes,
+# without the newline ending each clip.
+ENTRY_HEADER = struct.Struct('!idq')
+
+# header of each entry replied by OP_FOLLOW (epoch, seq, time, digest),
+# followed by the text. An empty frame of status OK is sent as a
+# heartbeat.
+FOLLOW_HEADER = struct.Struct('!qqdq')
+HEARTBEAT_INTERVAL = 30 #seconds
+FOLLOW_BATCH = 256
+
+def get_socket_path():
+    return os.path.join(get_runtime_dir(), 'clipon.sock')
+
+class TransportError(Exception):
+    pass
+
+def recv_exact(sock, length):
+    """
+    Receive exactly length bytes into a preallocated buffer
+    """
+    buf = bytearray(length)
+    view = memoryview(buf)
+    pos = 0
+    while pos < length:
+        n = sock.recv_into(view[pos:], length - pos)
+        if n == 0:
+            raise TransportError("Connection closed")
+        pos += n
+    return buf
+
+def send_buffers(sock, buffers):
+    """
+    Gather write of all the buffers, which are not copied into a joined
+    one. A write may be partial, the rest is sent again until done.
+    """
+    buffers = [memoryview(b).cast('B') for b in buffers]
+    while len(buffers) > 0:
+        sent = sock.sendmsg(buffers)
+        while sent > 0 and len(buffers) > 0:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+        while len(buffers) > 0 and len(buffers[0]) == 0:
+            buffers.pop(0)
+
+def send_frame(sock, header, code, payload = b''):
+    if len(payload) > 0:
+        send_buffers(sock, [header.pack(code, len(payload)), payload])
+    else:
+        sock.sendall(header.pack(code, 0))
+
+class TransportHandler(socketserver.BaseRequestHandler):
+    """
+    Serve requests of one connection until it's closed
+    """
+    def handle(self):
+        sock = self.request
+        while True:
+            try:
+                header = recv_exact(sock, REQ_HEADER.size)
+            except (TransportError, OSError):
+                return
+
+            op, length = REQ_HEADER.unpack(header)
+            args = OP_ARGS.get(op, None)
+            if args is None or length != args.size:
+                # the stream can't be resynced, the payload is not read
+                try:
+                    send_frame(sock, REP_HEADER, ST_ERROR, b'Invalid request')
+                except OSError:
+                    pass
+                return
+
+            try:
+                payload = recv_exact(sock, length)
+                self.dispatch(sock, op, args.unpack(payload))
+            except (TransportError, BrokenPipeError, ConnectionResetError):
+                return
+
+    def dispatch(self, sock, op, args):
+        history = self.server.history
+        if op == OP_GET:
+            index, start, end = args
+            text = history.get_text(index, start, end)
+            if text is None:
+                send_frame(sock, REP_HEADER, ST_ERROR, b'No such entry')
+                return
+            send_frame(sock, REP_HEADER, ST_OK, text.encode('utf-8'))
+        elif op == OP_BLOB:
+            # sent straight from the mapped data file
+            data = history.get_data(args[0])
+            if data is None:
+                send_frame(sock, REP_HEADER, ST_ERROR, b'No such entry')
+                return
+            send_frame(sock, REP_HEADER, ST_OK, data)
+        elif op == OP_EXPORT:
+            start, end, limit = args
+            end = min(end, history.size())
+            for index in range(max(start, 0), end):
+                entry = history.get_entry(index)
+                data = history.get_data(index)
+                if entry is None or data is None:
+                    break
+                length = len(data) - (data[-1:] == b'\n')
+                # limit characters are at most 4 bytes each in UTF-8,
+                # the client cuts the text decoded at the limit
+                if limit * 4 < len(data):
+                    data = data[:limit * 4]
+                send_buffers(sock, [REP_HEADER.pack(ST_OK, ENTRY_HEADER.size + len(data)),
+                                    ENTRY_HEADER.pack(index, entry.time, length),
+                                    data])
+            send_frame(sock, REP_HEADER, ST_END)
+        elif op == OP_FOLLOW:
+            self.follow(sock, *args)
+
+    def follow(self, sock, epoch, seq):
+        """
+        Stream entries to a follower until the connection is closed.
+        Entries are sent in the order they were added to history, each
+        with its position in the log. The follower resumes from the
+        position after the last entry it has committed, or from the
+        start if the position is of another instance of the daemon.
+        """
+        server = self.server
+        history = server.history
+        if epoch != history.log_epoch:
+            seq = 0
+        epoch = history.log_epoch
+        while True:
+            with server.changed:
+                generation = server.generation
+            entries, end = history.entries_logged(seq, FOLLOW_BATCH)
+            if end == seq:
+                with server.changed:
+                    if generation == server.generation:
+                        server.changed.wait(HEARTBEAT_INTERVAL)
+                    idle = generation == server.generation
+                # not sent holding the condition, the capture thread
+                # would wait on a follower not reading
+                if idle:
+                    send_frame(sock, REP_HEADER, ST_OK)
+                continue
+
+            for i, entry in entries:
+                data = entry.data
+                if data is None:
+                    data = history.ps_history.read_data(entry)
+                if data is None:
+                    continue
+                send_buffers(sock, [REP_HEADER.pack(ST_OK, FOLLOW_HEADER.size + len(data)),
+                                    FOLLOW_HEADER.pack(epoch, i, entry.time, entry.digest),
+                                    data])
+            seq = end
+
+class TransportServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Listen on the unix socket and serve each client in its own thread
+    """
+    daemon_threads = True
+    history = None
+    thread = None
+    changed = None
+    generation = 0
+
+    def __init__(self, path, history):
+        self.history = history
+        # followers wait on it for new entries
+        self.changed = threading.Condition()
+        history.add_listener(self.on_history_event)
+        sock_dir = os.path.dirname(path)
+        if not os.path.exists(sock_dir):
+            os.makedirs(sock_dir, 0o700)
+        if os.path.exists(path):
+            os.unlink(path) # stale socket of a dead daemon
+
+        socketserver.ThreadingUnixStreamServer.__init__(self, path,
+                                                        TransportHandler)
+        os.chmod(path, 0o600)
+
+    def on_history_event(self, event, index):
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Transport listening on %s", self.server_address)
+
+    def stop(self):
+        self.history.remove_listener(self.on_history_event)
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+        logger.info("Transport stopped")
+
+class TransportClient:
+    """
+    Blocking client of the transport socket
+    """
+    sock = None
+
+    def __init__(self, path = None):
+        if path is None:
+            path = get_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, op, *args):
+        payload = OP_ARGS[op].pack(*args)
+        send_frame(self.sock, REQ_HEADER, op, payload)
+
+    def reply(self):
+        status, length = REP_HEADER.unpack(recv_exact(self.sock, REP_HEADER.size))
+        payload = recv_exact(self.sock, length)
+        if status == ST_ERROR:
+            raise TransportError(payload.decode('utf-8'))
+        return status, payload
+
+    def get(self, index, start = 0, end = INT_MAX):
+        """
+        Return bytes of the text slice [start, end) of an entry
+        """
+        self.request(OP_GET, index, start, end)
+        return self.reply()[1]
+
+    def get_many(self, indexes, start = 0, end = INT_MAX):
+        """
+        Return a list of bytes of the text slices [start, end) of
+        entries, None for those not existing. Requests are all sent
+        before reading the replies, saving a round trip per entry.
+        """
+        for index in indexes:
+            self.request(OP_GET, index, start, end)
+        found = []
+        for index in indexes:
+            status, length = REP_HEADER.unpack(recv_exact(self.sock, REP_HEADER.size))
+            payload = recv_exact(self.sock, length)
+            found.append(payload if status == ST_OK else None)
+        return found
+
+    def blob(self, index):
+        """
+        Return bytes of the whole text of an entry
+        """
+        self.request(OP_BLOB, index)
+        return self.reply()[1]
+
+    def follow(self, epoch, seq):
+        """
+        Iterate over (epoch, seq, time, digest, data) of entries logged
+        from the position (epoch, seq) on, waiting for new entries
+        endlessly
+        """
+        self.request(OP_FOLLOW, epoch, seq)
+        while True:
+            status, payload = self.reply()
+            if len(payload) == 0:
+                continue #heartbeat
+            epoch, seq, time, digest = FOLLOW_HEADER.unpack_from(payload)
+            yield epoch, seq, time, digest, memoryview(payload)[FOLLOW_HEADER.size:]
+
+    def export(self, start, end, limit = INT_MAX):
+        """
+        Iterate over (index, time, length, data) of entries in range
+        [start, end), where data is a memoryview of the text bytes, at
+        least its first limit characters, and length the size of the
+        whole text without the ending newline
+        """
+        self.request(OP_EXPORT, start, end, limit)
+        while True:
+            status, payload = self.reply()
+            if status == ST_END:
+                return
+            index, time, length = ENTRY_HEADER.unpack_from(payload)
+            yield index, time, length, memoryview(payload)[ENTRY_HEADER.size:]
@@ -50,6 +50,10 @@ setup(
         'docopt'
     ],
 
+    extras_require={
+        'async': ['dbus-next'],
+    },
+
     entry_points={
         'console_scripts': [
             'clipon = clipon.clipon:main'
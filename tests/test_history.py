@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import types
+import pytest
+
+CLIPON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'clipon')
+sys.path.insert(0, CLIPON_DIR)
+
+try:
+    import gi.repository.GLib
+except ImportError:
+    # only the data directory is used from GLib, stubbed by the fixture
+    gi = types.ModuleType('gi')
+    gi.repository = types.ModuleType('gi.repository')
+    gi.repository.GLib = types.ModuleType('gi.repository.GLib')
+    gi.repository.GLib.get_user_data_dir = lambda: None
+    sys.modules.update({'gi': gi, 'gi.repository': gi.repository,
+                        'gi.repository.GLib': gi.repository.GLib})
+
+import history
+from helper import INT_MAX
+
+"""
+Tests of the history file: migration of the text format, recovery of
+records after a crash and saving and deleting entries
+"""
+
+class Config:
+    """
+    Settings of the daemon, without the config file
+    """
+    def __init__(self, **values):
+        self.values = {'autosave': True, 'max_entry': INT_MAX,
+                       'max_length': INT_MAX, 'max_age': None}
+        self.values.update(values)
+        self.methods = {}
+
+    def get_value(self, key):
+        return self.values.get(key)
+
+    def set_value(self, key, value):
+        self.values[key] = value
+
+    def set_method(self, key, method):
+        self.methods[key] = method
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, 'get_user_data_dir', lambda: str(tmp_path))
+    return tmp_path / 'clipon'
+
+def texts(clip_history):
+    return [clip_history.get_text(i) for i in range(clip_history.size())]
+
+def test_migrate_text_history(data_dir):
+    data_dir.mkdir()
+    (data_dir / 'history.txt').write_text('héllo\nwörld ünïcode\n',
+                                          encoding='utf-8')
+    # offsets and lengths of the text format are in characters
+    (data_dir / 'clipon.xml').write_text(
+        '<clipon_history version="1.0.0">'
+        '<clip time="1.0" offset="0" length="6"/>'
+        '<clip time="2.0" offset="7" length="14"/>'
+        '</clipon_history>')
+
+    clip_history = history.ClipHistory(Config())
+    assert texts(clip_history) == ['héllo\n', 'wörld ünïcode\n']
+    assert sorted(os.listdir(data_dir)) == ['clipon.xml', 'history.dat']
+
+    clip_history = history.ClipHistory(Config())
+    assert texts(clip_history) == ['héllo\n', 'wörld ünïcode\n']
+    assert [index for index, entry in clip_history.search('ünï')] == [1]
+
+def test_recover_unsynced_records(data_dir):
+    clip_history = history.ClipHistory(Config())
+    clip_history.add_text('synced')
+    clip_history.sync()
+    clip_history.add_text('not synced')
+    clip_history.add_text('ünsynced')
+    # crash, the meta file doesn't have the last two entries
+    meta = (data_dir / 'clipon.xml').read_text()
+    assert 'not synced' not in meta and meta.count('<clip ') == 1
+
+    recovered = history.ClipHistory(Config())
+    assert texts(recovered) == ['synced\n', 'not synced\n', 'ünsynced\n']
+    assert (data_dir / 'clipon.xml').read_text().count('<clip ') == 3
+    assert texts(history.ClipHistory(Config())) == texts(recovered)
+
+def test_truncate_corrupted_tail(data_dir):
+    clip_history = history.ClipHistory(Config())
+    clip_history.add_text('first')
+    clip_history.add_text('second')
+    clip_history.sync()
+    end = os.path.getsize(data_dir / 'history.dat')
+    clip_history.add_text('torn write')
+    clip_history.ps_history.data_fd.flush()
+
+    # flip a byte of the text of the last record
+    with open(data_dir / 'history.dat', 'r+b') as f:
+        f.seek(-3, 2)
+        byte = f.read(1)
+        f.seek(-3, 2)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+    recovered = history.ClipHistory(Config())
+    assert texts(recovered) == ['first\n', 'second\n']
+    assert os.path.getsize(data_dir / 'history.dat') == end
+    recovered.add_text('third')
+    assert texts(history.ClipHistory(Config())) == ['first\n', 'second\n',
+                                                    'third\n']
+
+def test_save_all_reuses_records(data_dir):
+    clip_history = history.ClipHistory(Config())
+    clip_history.add_text('kept one')
+    clip_history.add_text('kept two')
+    clip_history.sync()
+    offsets = list(clip_history.history.offsets)
+    size = os.path.getsize(data_dir / 'history.dat')
+
+    clip_history.set_autosave(False)
+    clip_history.add_text('new')
+    assert os.path.getsize(data_dir / 'history.dat') == size
+    clip_history.set_autosave(True)
+
+    # the records on file are kept as is, only the new one is written
+    assert list(clip_history.history.offsets)[:2] == offsets
+    record = history.RECORD_HEADER.size + len('new\n')
+    assert os.path.getsize(data_dir / 'history.dat') == size + record
+    assert texts(history.ClipHistory(Config())) == ['kept one\n', 'kept two\n',
+                                                    'new\n']
+
+def test_del_head_keeps_pinned(data_dir):
+    clip_history = history.ClipHistory(Config())
+    for text in ('a', 'b', 'c', 'd', 'e'):
+        clip_history.add_text(text)
+    clip_history.pin(1)
+
+    # pinned entries are kept, and as many newer ones are deleted
+    clip_history.del_head(2)
+    assert texts(clip_history) == ['b\n', 'd\n', 'e\n']
+    assert clip_history.pinned_indexes() == [0]
+
+    clip_history.sync()
+    reloaded = history.ClipHistory(Config())
+    assert texts(reloaded) == ['b\n', 'd\n', 'e\n']
+    assert reloaded.pinned_indexes() == [0]
+
+    reloaded.del_head(10)
+    assert texts(reloaded) == ['b\n']
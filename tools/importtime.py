@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Import time check of the clipon command line
+
+usage: importtime.py [options]
+
+Import the modules run by every clipon command, clipon and client, with
+'python -X importtime', and fail if they import modules that only some
+commands need, or take longer than the budget. Modules already imported
+by the interpreter at startup are not counted.
+
+Options:
+  --budget=<ms>       Import time allowed for the modules, in
+                      milliseconds [default: 50]
+  --runs=<number>     Number of runs, the fastest is checked [default: 5]
+  --forbid=<modules>  Comma separated modules not to be imported
+                      [default: docopt,json,subprocess]
+  --verbose -v        Print the slowest imports of the fastest run
+
+Example:
+
+  check with a budget of 30 milliseconds
+    $ python tools/importtime.py --budget=30
+"""
+
+import os
+import sys
+import subprocess
+
+CLIPON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'clipon')
+
+MODULES = ('clipon', 'client')
+
+def run_importtime(statement):
+    """
+    Run the statement in a new interpreter with -X importtime, and
+    return its imports as (name, self, cumulative) tuples, in
+    microseconds, in the order they finished
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [CLIPON_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                          env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    imports = []
+    errors = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            errors.append(line)
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            imports.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+        except (IndexError, ValueError):
+            pass #the header line
+    if proc.returncode != 0:
+        raise RuntimeError('\n'.join(errors))
+    return imports
+
+def import_time(imports):
+    """
+    Cumulative import time of the checked modules, in microseconds
+    """
+    return sum(cumulative for name, _, cumulative in imports
+               if name in MODULES)
+
+def check(imports, startup, budget, forbid):
+    """
+    Return the reasons of failure found in the imports of a run
+    """
+    failures = []
+    names = set(name for name, _, _ in imports) - startup
+    for name in sorted(names):
+        if name.split('.')[0] in forbid:
+            failures.append("%s is imported" % name)
+
+    total = import_time(imports)
+    if total > budget * 1000:
+        failures.append("Import took %.1fms, over the budget of %.1fms" %
+                        (total / 1000.0, budget))
+    return failures
+
+def main(argv):
+    from docopt import docopt
+    args = docopt(__doc__, argv)
+    budget = float(args['--budget'])
+    forbid = set(name.strip() for name in args['--forbid'].split(','))
+
+    startup = set(name for name, _, _ in run_importtime('pass'))
+    statement = 'import ' + ', '.join(MODULES)
+    try:
+        runs = [run_importtime(statement) for i in range(int(args['--runs']))]
+    except RuntimeError as e:
+        print("FAIL: could not import %s\n%s" % (', '.join(MODULES), e),
+              file=sys.stderr)
+        return 1
+
+    fastest = min(runs, key=import_time)
+
+    if args['--verbose']:
+        slowest = sorted((i for i in fastest if i[0] not in startup),
+                         key=lambda i: i[1], reverse=True)
+        for name, own, cumulative in slowest[:15]:
+            print("%8.1fms %8.1fms  %s" % (own / 1000.0, cumulative / 1000.0,
+                                           name))
+
+    failures = check(fastest, startup, budget, forbid)
+    for failure in failures:
+        print("FAIL: %s" % failure, file=sys.stderr)
+    if len(failures) == 0:
+        print("PASS: %.1fms" % (import_time(fastest) / 1000.0), file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Soak test of the clipon daemon
+
+usage: soak.py [options]
+
+Run the daemon on a private session bus, with a fake clipboard copying
+clips at a steady rate, while worker processes list, search and delete
+entries through DBus. Memory of the daemon and latencies of requests
+are sampled over time and written as JSON lines. It fails if traced
+memory keeps growing or tail latencies get worse after the warmup.
+
+Options:
+  --duration=<seconds>   How long to run [default: 3600]
+  --rate=<number>        Clips copied per second [default: 20]
+  --workers=<number>     Number of client processes [default: 4]
+  --interval=<seconds>   Seconds between samples [default: 10]
+  --warmup=<seconds>     Seconds from the start whose samples are not
+                         checked [default: 60]
+  --max-entry=<number>   Maximum number of history entries, so that
+                         memory is expected to level off [default: 10000]
+  --clip-size=<number>   Average clip length in characters [default: 200]
+  --max-growth=<bytes>   Traced memory allowed to grow after the warmup
+                         [default: 8388608]
+  --max-slowdown=<ratio> Worst p99 latency at the end allowed, relative
+                         to the one after the warmup [default: 3]
+  --report=<file>        Write samples to the file instead of stdout
+  --keep                 Keep the temporary directory of the daemon
+
+Example:
+
+  one day at 50 clips per second, checked every minute
+    $ python tools/soak.py --duration=86400 --rate=50 --interval=60
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'clipon'))
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua ssh '
+         'git commit https www example com kubectl docker build').split()
+
+LATENCY_FLOOR = 0.005 #seconds, slowdowns below are not counted
+
+def make_clip(rng, size):
+    """
+    Text of a clip. Some are copied again as is, some again with a new
+    timestamp, like logs, to exercise the dedupe and similarity paths.
+    """
+    words = [rng.choice(WORDS) for i in range(max(1, int(rng.expovariate(1.0 / size) / 6)))]
+    text = ' '.join(words)
+    kind = rng.random()
+    if kind < 0.1:
+        text = 'build started at %s' % time.strftime('%H:%M:%S')
+    elif kind < 0.2:
+        text = rng.choice(WORDS[-10:])
+    return text
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    def at(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return {'n': len(values), 'p50': at(0.5), 'p95': at(0.95),
+            'p99': at(0.99), 'max': values[-1]}
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.stat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+class FakeClipboard(threading.Thread):
+    """
+    Stand-in of the headless clip source, copying clips at a given rate
+    """
+    kind = 'soak'
+    path = None #no FIFO, shown by get_info
+    rate = 20
+    size = 200
+
+    def __init__(self, history):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.history = history
+        self.stopped = threading.Event()
+        self.paused = False
+        self.lock = threading.Lock()
+        self.latencies = []
+
+    def stop(self):
+        self.stopped.set()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def push(self, text):
+        if self.paused:
+            return False
+        self.history.add_text(text)
+        return True
+
+    def run(self):
+        rng = random.Random(0)
+        period = 1.0 / self.rate
+        next_time = time.time()
+        while not self.stopped.is_set():
+            if not self.paused:
+                text = make_clip(rng, self.size)
+                begin = time.perf_counter()
+                self.history.add_text(text)
+                latency = time.perf_counter() - begin
+                with self.lock:
+                    self.latencies.append(latency)
+
+            next_time += period
+            delay = next_time - time.time()
+            if delay > 0:
+                self.stopped.wait(delay)
+
+    def take_latencies(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+def serve(args, notify_fd):
+    """
+    Run the daemon in this process, with the fake clipboard, and print
+    a sample of its memory every interval
+    """
+    import tracemalloc
+    tracemalloc.start()
+
+    import daemon
+    FakeClipboard.rate = float(args['--rate'])
+    FakeClipboard.size = int(args['--clip-size'])
+    daemon.HeadlessSource = FakeClipboard
+    clipon = daemon.CliponDaemon(notify_fd, headless=True)
+    data_dir = os.path.join(os.environ['XDG_DATA_HOME'], 'clipon')
+    interval = float(args['--interval'])
+
+    def sample():
+        while True:
+            time.sleep(interval)
+            monitor = clipon.monitor
+            if monitor is None:
+                continue
+            current, peak = tracemalloc.get_traced_memory()
+            print(json.dumps({
+                'traced': current,
+                'traced_peak': peak,
+                'rss': rss(),
+                'disk': dir_size(data_dir),
+                'size': clipon.history.size(),
+                'capture': percentiles(monitor.take_latencies()),
+            }), flush=True)
+
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+    clipon.run()
+
+def worker(seed, interval, queue, stopped):
+    """
+    Hammer the daemon with requests, and put the latencies of each kind
+    of request into the queue every interval
+    """
+    import dbus
+    from defines import CLIPON_BUS_NAME, CLIPON_OBJ_PATH
+
+    bus = dbus.SessionBus()
+    proxy = bus.get_object(CLIPON_BUS_NAME, CLIPON_OBJ_PATH, introspect=False)
+
+    def method(name):
+        return proxy.get_dbus_method(name, CLIPON_BUS_NAME + '.' + name)
+
+    history_size = method('history_size')
+    get_clip_range = method('get_clip_range')
+    search_history = method('search_history')
+    del_history = method('del_history')
+
+    rng = random.Random(seed)
+    latencies = {}
+    last = time.time()
+    while not stopped.is_set():
+        kind = rng.random()
+        begin = time.perf_counter()
+        try:
+            if kind < 0.5:
+                size = history_size()
+                for index in range(max(0, size - 20), size):
+                    get_clip_range(index, 0, 80)
+                op = 'list'
+            elif kind < 0.9:
+                search_history(rng.choice(WORDS), 20)
+                op = 'search'
+            elif kind < 0.99:
+                history_size()
+                op = 'size'
+            else:
+                size = history_size()
+                if size > 1:
+                    index = rng.randrange(1, size)
+                    del_history(index, index + 1)
+                op = 'delete'
+        except dbus.exceptions.DBusException as e:
+            op = 'error'
+            print("Request failed: %s" % e, file=sys.stderr)
+        latencies.setdefault(op, []).append(time.perf_counter() - begin)
+
+        if time.time() - last >= interval:
+            queue.put(latencies)
+            latencies = {}
+            last = time.time()
+
+def start_bus():
+    bus = subprocess.Popen(['dbus-daemon', '--session', '--nofork',
+                            '--print-address=1'],
+                           stdout=subprocess.PIPE, universal_newlines=True)
+    address = bus.stdout.readline().strip()
+    if not address:
+        raise RuntimeError("Failed to start dbus-daemon")
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+    return bus
+
+def start_daemon(argv, timeout = 30):
+    read_fd, write_fd = os.pipe()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--serve=%d' % write_fd] + argv,
+                            pass_fds=(write_fd,), stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        import select
+        ready, _, _ = select.select([f], [], [], timeout)
+        msg = f.readline().strip() if ready else ''
+    if msg != 'READY':
+        proc.kill()
+        raise RuntimeError("Daemon failed to start: %s" % (msg or 'timeout'))
+    return proc
+
+def stop_daemon(proc):
+    import dbus
+    from defines import CLIPON_BUS_NAME, CLIPON_OBJ_PATH
+    try:
+        proxy = dbus.SessionBus().get_object(CLIPON_BUS_NAME, CLIPON_OBJ_PATH,
+                                             introspect=False)
+        proxy.get_dbus_method('stop', CLIPON_BUS_NAME + '.stop')()
+    except dbus.exceptions.DBusException:
+        pass
+    try:
+        proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def check(samples, warmup, max_growth, max_slowdown):
+    """
+    Return the reasons of failure found in the samples after warmup
+    """
+    samples = [s for s in samples if s['elapsed'] >= warmup]
+    if len(samples) < 4:
+        return ["Too few samples after warmup to check"]
+
+    failures = []
+    # memory shall level off as the history is bounded by max_entry,
+    # medians of the first and the last quarter are compared
+    quarter = max(1, len(samples) // 4)
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+    traced = [s['daemon']['traced'] for s in samples if 'daemon' in s]
+    if len(traced) >= 4:
+        growth = median(traced[-quarter:]) - median(traced[:quarter])
+        if growth > max_growth:
+            failures.append("Traced memory grew by %d bytes" % growth)
+
+    ops = set()
+    for s in samples:
+        ops.update(s['latency'])
+    for op in sorted(ops):
+        p99 = [s['latency'][op]['p99'] for s in samples if op in s['latency']]
+        if len(p99) < 4:
+            continue
+        first = median(p99[:quarter])
+        last = median(p99[-quarter:])
+        if last > LATENCY_FLOOR and last > first * max_slowdown:
+            failures.append("p99 latency of %s went from %.3fms to %.3fms" %
+                            (op, first * 1000, last * 1000))
+    return failures
+
+def main(argv):
+    from docopt import docopt
+    serve_fd = None
+    for arg in argv:
+        if arg.startswith('--serve='):
+            serve_fd = int(arg[len('--serve='):])
+    options = [arg for arg in argv if not arg.startswith('--serve=')]
+    args = docopt(__doc__, options)
+
+    if serve_fd is not None:
+        serve(args, serve_fd)
+        return 0
+
+    duration = float(args['--duration'])
+    interval = float(args['--interval'])
+    tmp_dir = tempfile.mkdtemp(prefix='clipon-soak-')
+    for name in ('XDG_RUNTIME_DIR', 'XDG_DATA_HOME', 'XDG_CONFIG_HOME',
+                 'XDG_CACHE_HOME'):
+        path = os.path.join(tmp_dir, name.lower())
+        os.makedirs(path, 0o700)
+        os.environ[name] = path
+
+    cfg_dir = os.path.join(os.environ['XDG_CONFIG_HOME'], 'clipon')
+    os.makedirs(cfg_dir)
+    with open(os.path.join(cfg_dir, 'clipon.conf'), 'w') as f:
+        json.dump({'max_entry': int(args['--max-entry'])}, f)
+
+    report = open(args['--report'], 'w') if args['--report'] else sys.stdout
+    bus = start_bus()
+    proc = None
+    workers = []
+    stopped = multiprocessing.Event()
+    try:
+        proc = start_daemon(options)
+
+        # samples printed by the daemon
+        daemon_samples = []
+        def read_samples():
+            for line in proc.stdout:
+                try:
+                    daemon_samples.append(json.loads(line))
+                except ValueError:
+                    pass
+        reader = threading.Thread(target=read_samples)
+        reader.daemon = True
+        reader.start()
+
+        queue = multiprocessing.Queue()
+        for i in range(int(args['--workers'])):
+            p = multiprocessing.Process(target=worker,
+                                        args=(i, interval, queue, stopped))
+            p.start()
+            workers.append(p)
+
+        samples = []
+        start = time.time()
+        while time.time() - start < duration:
+            time.sleep(interval)
+            latencies = {}
+            while not queue.empty():
+                for op, values in queue.get().items():
+                    latencies.setdefault(op, []).extend(values)
+
+            sample = {'elapsed': round(time.time() - start, 1),
+                      'latency': {op: percentiles(v) for op, v in latencies.items()}}
+            if len(daemon_samples) > 0:
+                sample['daemon'] = daemon_samples[-1]
+            samples.append(sample)
+            report.write(json.dumps(sample) + '\n')
+            report.flush()
+
+        failures = check(samples, float(args['--warmup']),
+                         int(args['--max-growth']), float(args['--max-slowdown']))
+    finally:
+        stopped.set()
+        for p in workers:
+            p.join(10)
+            if p.is_alive():
+                p.terminate()
+        if proc is not None:
+            stop_daemon(proc)
+        bus.send_signal(signal.SIGTERM)
+        bus.wait()
+        if report is not sys.stdout:
+            report.close()
+        if not args['--keep']:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for failure in failures:
+        print("FAIL: %s" % failure, file=sys.stderr)
+    if len(failures) == 0:
+        print("PASS", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))